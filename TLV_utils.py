@@ -1,4 +1,4 @@
-import binascii, utils, re, sys
+import binascii, utils, re, sys, bisect
 
 class identifier:
     """An identifier, because I'm too lazy to use quotes all over the place.
@@ -337,42 +337,55 @@ BER_CLASSES = {
     0x3: "private",
 }
 
-def tlv_unpack(data):
-    ber_class = (ord(data[0]) & 0xC0) >> 6
-    constructed = (ord(data[0]) & 0x20) != 0 ## 0 = primitive, 0x20 = constructed
-    tag = ord(data[0]) 
-    data = data[1:]
+def tlv_read_header(data, pos = 0, end = None):
+    """Read the tag and length of the TLV element that starts at data[pos], without
+    copying anything. Returns (ber_class, constructed, tag, length, value_pos).
+    Raises IndexError if the header extends beyond end (default: the end of data)."""
+    first = ord(data[pos])
+    ber_class = (first & 0xC0) >> 6
+    constructed = (first & 0x20) != 0 ## 0 = primitive, 0x20 = constructed
+    tag = first
+    pos = pos + 1
     if (tag & 0x1F) == 0x1F:
-        tag = (tag << 8) | ord(data[0])
-        while ord(data[0]) & 0x80 == 0x80:
-            data = data[1:]
-            tag = (tag << 8) | ord(data[0])
-        data = data[1:]
+        tag = (tag << 8) | ord(data[pos])
+        while ord(data[pos]) & 0x80 == 0x80:
+            pos = pos + 1
+            tag = (tag << 8) | ord(data[pos])
+        pos = pos + 1
     
-    length = ord(data[0])
-    if length < 0x80:
-        data = data[1:]
-    elif length & 0x80 == 0x80:
+    length = ord(data[pos])
+    pos = pos + 1
+    if length & 0x80 == 0x80:
         length_ = 0
-        data = data[1:]
         for i in range(0,length & 0x7F):
-            length_ = length_ * 256 + ord(data[0])
-            data = data[1:]
+            length_ = length_ * 256 + ord(data[pos])
+            pos = pos + 1
         length = length_
     
-    value = data[:length]
-    rest = data[length:]
+    if end is not None and pos > end:
+        raise IndexError, "TLV header extends beyond the end of the data"
+    
+    return ber_class, constructed, tag, length, pos
+
+def tlv_unpack(data):
+    ber_class, constructed, tag, length, pos = tlv_read_header(data)
+    value = data[pos:pos+length]
+    rest = data[pos+length:]
     
     return ber_class, constructed, tag, length, value, rest
 
 def decode(data, context = None, level = 0, tags=tags):
+    return _decode(data, 0, len(data), context, level, tags)
+
+def _decode(data, pos, end, context, level, tags):
     result = []
-    while len(data) > 0:
-        if ord(data[0]) in (0x00, 0xFF):
-            data = data[1:]
+    while pos < end:
+        if data[pos] in "\x00\xFF":
+            pos = pos + 1
             continue
         
-        ber_class, constructed, tag, length, value, data = tlv_unpack(data)
+        ber_class, constructed, tag, length, value_pos = tlv_read_header(data, pos, end)
+        pos = min(value_pos + length, end)
         
         interpretation = tags.get(context, tags.get(None, {})).get(tag, None)
         if interpretation is None:
@@ -387,33 +400,57 @@ def decode(data, context = None, level = 0, tags=tags):
         
         if interpretation[0] is recurse:
             current.append("\n")
-            current.append( decode(value, interpretation[2], level+1, tags=tags) )
-        elif interpretation[0] is number:
-            num = 0
-            for i in value:
-                num = num * 256
-                num = num + ord(i)
-            current.append( " 0x%02x (%i)" % (num, num))
-        elif interpretation[0] is ascii:
-            current.append( " %s" % value)
-        elif interpretation[0] is utf8:
-            current.append( " %s" % unicode(value, "utf-8"))
-        elif interpretation[0] is binary:
-            if len(value) < 0x10:
-                current.append( " %s" % utils.hexdump(value, short=True))
-            else:
-                current.append( "\n" + "\t"*(level+1) )
-                current.append( ("\n" + "\t"*(level+1)).join( utils.hexdump(value).splitlines() ) )
-        elif callable(interpretation[0]):
-            current.append( ("\n"+"\t"*(level+1)).join(interpretation[0](value).splitlines()) )
+            current.append( _decode(data, value_pos, pos, interpretation[2], level+1, tags) )
+        else:
+            value = data[value_pos:pos]
+            if interpretation[0] is number:
+                num = 0
+                for i in value:
+                    num = num * 256
+                    num = num + ord(i)
+                current.append( " 0x%02x (%i)" % (num, num))
+            elif interpretation[0] is ascii:
+                current.append( " %s" % value)
+            elif interpretation[0] is utf8:
+                current.append( " %s" % unicode(value, "utf-8"))
+            elif interpretation[0] is binary:
+                if len(value) < 0x10:
+                    current.append( " %s" % utils.hexdump(value, short=True))
+                else:
+                    current.append( "\n" + "\t"*(level+1) )
+                    current.append( ("\n" + "\t"*(level+1)).join( utils.hexdump_lines(value) ) )
+            elif callable(interpretation[0]):
+                current.append( ("\n"+"\t"*(level+1)).join(interpretation[0](value).splitlines()) )
         
         result.append( "".join(current) )
     
     return "\n".join(result)
 
+def decode_node(node, context = None, level = 0, tags=tags):
+    """Like decode(), for a TLV_Node. The context is derived from the elements that 
+    contain the node, starting with context at the root, like decode() would."""
+    ancestors = []
+    parent = node.parent
+    while parent is not None and parent.tag is not None:
+        ancestors.append(parent)
+        parent = parent.parent
+    ancestors.reverse()
+    
+    for ancestor in ancestors:
+        interpretation = tags.get(context, tags.get(None, {})).get(ancestor.tag, None)
+        if interpretation is None:
+            if ancestor.ber_class not in (0, 1):
+                context = None
+        elif interpretation[0] is recurse:
+            context = interpretation[2]
+    
+    return _decode(node.data, node.offset, node.end, context, level, tags)
+
 def tlv_find_tag(tlv_data, tag, num_results = None):
     """Find (and return) all instances of tag in the given tlv structure (as returned by unpack).
-    If num_results is specified then at most that many results will be returned."""
+    If num_results is specified then at most that many results will be returned.
+    tlv_data may also be the binary TLV string: then only the matching elements
+    are unpacked."""
     
     results = []
     def find_recursive(tlv_data):
@@ -428,46 +465,441 @@ def tlv_find_tag(tlv_data, tag, num_results = None):
             if num_results is not None and len(results) >= num_results:
                 return
     
-    find_recursive(tlv_data)
+    def find_binary(data, pos, end):
+        while pos < end:
+            if data[pos] in "\x00\xFF":
+                pos = pos + 1
+                continue
+            
+            ber_class, constructed, t, length, value_pos = tlv_read_header(data, pos, end)
+            pos = min(value_pos + length, end)
+            if t == tag:
+                if constructed:
+                    results.append( (t, length, _unpack(data, value_pos, pos, 0, None, False)) )
+                else:
+                    results.append( (t, length, data[value_pos:pos]) )
+            elif constructed:
+                if find_binary(data, value_pos, pos):
+                    return True
+            
+            if num_results is not None and len(results) >= num_results:
+                return True
+        return False
+    
+    if isinstance(tlv_data, str):
+        find_binary(tlv_data, 0, len(tlv_data))
+    else:
+        find_recursive(tlv_data)
     
     return results
 
 def unpack(data, with_marks = None, offset = 0, include_filler=False):
+    marks = None
+    if with_marks is not None:
+        ## Index the marks by their (start, stop) offsets
+        marks = {}
+        for type, mark_start, mark_stop in with_marks:
+            marks.setdefault( (mark_start, mark_stop), [] ).append(type)
+    
+    return _unpack(data, 0, len(data), offset, marks, include_filler)
+
+def _unpack(data, pos, end, offset, marks, include_filler):
+    """Unpack data[pos:end] by offsets. offset is the offset (for the marks) of
+    data[pos]. Only the values of primitive elements are copied."""
     result = []
-    while len(data) > 0:
-        if ord(data[0]) in (0x00, 0xFF):
+    offset = offset - pos
+    while pos < end:
+        if data[pos] in "\x00\xFF":
             if include_filler:
-                if with_marks is None:
-                    result.append( (ord(data[0]), None, None) )
+                if marks is None:
+                    result.append( (ord(data[pos]), None, None) )
                 else:
-                    result.append( (ord(data[0]), None, None, () ) )
-            data = data[1:]
-            offset = offset + 1
+                    result.append( (ord(data[pos]), None, None, () ) )
+            pos = pos + 1
             continue
         
-        l = len(data)
-        ber_class, constructed, tag, length, value, data = tlv_unpack(data)
-        stop = offset + (l - len(data))
+        tag = ord(data[pos])
+        length = 0x80
+        if pos + 1 < end:
+            length = ord(data[pos+1])
+        if tag & 0x1F != 0x1F and length < 0x80:
+            ## Fast path for the common case of a one byte tag and a short length
+            constructed, value_pos = (tag & 0x20) != 0, pos + 2
+        else:
+            ber_class, constructed, tag, length, value_pos = tlv_read_header(data, pos, end)
+        pos = min(value_pos + length, end)
+        stop = offset + pos
         start = stop - length
         
-        if with_marks is not None:
-            marks = []
-            for type, mark_start, mark_stop in with_marks:
-                if (mark_start, mark_stop) == (start, stop):
-                    marks.append(type)
-            marks = (marks, )
+        if marks is not None:
+            element_marks = ( list(marks.get( (start, stop), () )), )
         else:
-            marks = ()
+            element_marks = ()
         
         if not constructed:
-            result.append( (tag, length, value) + marks )
+            result.append( (tag, length, data[value_pos:pos]) + element_marks )
         else:
-            result.append( (tag, length, unpack(value, with_marks, offset = start)) + marks )
+            result.append( (tag, length, _unpack(data, value_pos, pos, start, marks, False)) + element_marks )
+    
+    return result
+
+class TLV_Node(object):
+    """An element of a TLV structure that is parsed on demand. Only tag, length
+    and offsets into the original data are kept; the value is copied when the
+    value attribute is read and the children of a constructed element are only
+    parsed as far as they are iterated over or searched. Use lazy_unpack() to
+    get the root node of some data, and get_index() for repeated lookups."""
+    __slots__ = ("data", "ber_class", "constructed", "tag", "length", "offset", "value_offset", "end", "parent",
+        "_children", "_parse_pos", "_index")
+    
+    def __init__(self, data, ber_class, constructed, tag, length, offset, value_offset, end, parent = None):
+        self.data = data
+        self.ber_class, self.constructed, self.tag, self.length = ber_class, constructed, tag, length
+        self.offset, self.value_offset, self.end = offset, value_offset, end
+        self.parent = parent
+        self._index = None
+        self._children = []
+        if constructed:
+            self._parse_pos = value_offset
+        else:
+            self._parse_pos = None
+    
+    value = property(lambda self: self.data[self.value_offset:self.end], None, None,
+        "The binary value of this element")
+    encoded = property(lambda self: self.data[self.offset:self.end], None, None,
+        "The binary encoding of this element, including tag and length")
+    
+    def _parse_next(self):
+        "Parse the next child element. Returns False when all children have been parsed."
+        data, pos, end = self.data, self._parse_pos, self.end
+        if pos is None:
+            return False
+        while pos < end and data[pos] in "\x00\xFF":
+            pos = pos + 1
+        if pos >= end:
+            self._parse_pos = None
+            return False
         
-        offset = stop
+        ber_class, constructed, tag, length, value_pos = tlv_read_header(data, pos, end)
+        stop = min(value_pos + length, end)
+        self._children.append( TLV_Node(data, ber_class, constructed, tag, length, pos, value_pos, stop, self) )
+        self._parse_pos = stop
+        return True
+    
+    def _get_children(self):
+        if self._parse_pos is not None:
+            self._children.extend( _parse_nodes(self.data, self._parse_pos, self.end, self) )
+            self._parse_pos = None
+        return self._children
+    children = property(_get_children, None, None,
+        "The list of elements contained in this element (all of them are parsed on access)")
+    
+    def __iter__(self):
+        children = self._children
+        index = 0
+        while index < len(children) or self._parse_next():
+            yield children[index]
+            index = index + 1
+    
+    def __len__(self):
+        return len(self.children)
+    
+    def __getitem__(self, index):
+        return self.children[index]
+    
+    def find(self, tag, num_results = None):
+        """Find all instances of tag below this element, like tlv_find_tag() does: 
+        the children of matching elements are not searched. Searching stops after
+        num_results results, with only the elements up to the last result parsed."""
+        results = []
+        def find_recursive(node):
+            if num_results is None:
+                children = node.children
+            else:
+                children = node
+            for child in children:
+                if child.tag == tag:
+                    results.append(child)
+                elif child.constructed:
+                    find_recursive(child)
+                
+                if num_results is not None and len(results) >= num_results:
+                    return
+        find_recursive(self)
+        return results
+    
+    def find_first(self, tag):
+        "Return the first instance of tag below this element, or None"
+        results = self.find(tag, 1)
+        if len(results) == 0:
+            return None
+        return results[0]
+    
+    def get_index(self):
+        "Return the TLV_Index for the elements below this element. It is built on the first call."
+        if self._index is None:
+            self._index = TLV_Index(self)
+        return self._index
+    
+    def get_path(self):
+        "Return the tuple of tags from the root (exclusive) down to this element"
+        path = []
+        node = self
+        while node is not None and node.tag is not None:
+            path.append(node.tag)
+            node = node.parent
+        path.reverse()
+        return tuple(path)
+    
+    def to_tuple(self):
+        "Return this element in the format of unpack(): (tag, length, value or list of children)"
+        if self.constructed:
+            return (self.tag, self.length, [child.to_tuple() for child in self.children])
+        return (self.tag, self.length, self.value)
+    
+    def __repr__(self):
+        if self.tag is None:
+            return "<%s root, %i bytes>" % (self.__class__.__name__, self.end - self.value_offset)
+        return "<%s tag 0x%02X, length 0x%02X at offset %i>" % (self.__class__.__name__, self.tag, self.length, self.offset)
+
+def _parse_nodes(data, pos, end, parent):
+    result = []
+    while pos < end:
+        if data[pos] in "\x00\xFF":
+            pos = pos + 1
+            continue
+        
+        ber_class, constructed, tag, length, value_pos = tlv_read_header(data, pos, end)
+        stop = min(value_pos + length, end)
+        result.append( TLV_Node(data, ber_class, constructed, tag, length, pos, value_pos, stop, parent) )
+        pos = stop
     
     return result
 
+def lazy_unpack(data):
+    """Return a TLV_Node for data, with tag None. Its children are the top level 
+    elements of data. Nothing is parsed until the tree is iterated over or searched."""
+    return TLV_Node(data, None, True, None, len(data), 0, 0, len(data))
+
+def parse_tlv_path(path):
+    """Parse a path like "77/30/A0/30" (hex tags separated by /, * matches any tag) into 
+    a tuple of tags, with None for *. Leading and trailing slashes are ignored."""
+    steps = []
+    for step in path.strip().strip("/").split("/"):
+        step = step.strip()
+        if step == "*":
+            steps.append(None)
+        else:
+            try:
+                steps.append(int(step, 16))
+            except ValueError:
+                raise ValueError, "Invalid tag %r in TLV path %r" % (step, path)
+    return tuple(steps)
+
+def format_tlv_path(path):
+    "The inverse of parse_tlv_path()"
+    return "/".join([tag is None and "*" or "%02X" % tag for tag in path])
+
+class TLV_Index(object):
+    """An index over a TLV_Node tree: maps tags and paths to the elements. Building
+    it parses the whole tree once, afterwards find() and query() are dictionary
+    lookups. Get it with TLV_Node.get_index() to build it only once per tree."""
+    
+    def __init__(self, root):
+        if isinstance(root, str):
+            root = lazy_unpack(root)
+        self.root = root
+        ## tag -> all elements with that tag, in the order of the data
+        self.by_tag = {}
+        ## tuple of tags -> elements at that path
+        self.by_path = {}
+        ## tag -> elements that are not contained in an element with the same tag
+        self._outermost = {}
+        self._add_children(root, (), {})
+    
+    def _add_children(self, node, path, open_tags):
+        for child in node.children:
+            tag = child.tag
+            child_path = path + (tag, )
+            self.by_tag.setdefault(tag, []).append(child)
+            self.by_path.setdefault(child_path, []).append(child)
+            if open_tags.get(tag, 0) == 0:
+                self._outermost.setdefault(tag, []).append(child)
+            
+            if child.constructed:
+                open_tags[tag] = open_tags.get(tag, 0) + 1
+                self._add_children(child, child_path, open_tags)
+                open_tags[tag] = open_tags[tag] - 1
+    
+    def find(self, tag, num_results = None, nested = False):
+        """Return the elements with tag. Like tlv_find_tag() this doesn't include
+        elements that are contained in another element with the same tag, unless
+        nested is set."""
+        if nested:
+            results = self.by_tag.get(tag, [])
+        else:
+            results = self._outermost.get(tag, [])
+        if num_results is not None:
+            return results[:num_results]
+        return list(results)
+    
+    def query(self, path):
+        """Return the elements at path, a string like "77/30/A0/30" or a tuple as
+        returned by parse_tlv_path(). The first tag is matched against the top level
+        elements, each further tag against the children of the previous matches."""
+        if isinstance(path, basestring):
+            path = parse_tlv_path(path)
+        else:
+            path = tuple(path)
+        
+        if None not in path:
+            return list(self.by_path.get(path, []))
+        
+        results = []
+        for key, nodes in self.by_path.items():
+            if len(key) != len(path):
+                continue
+            for tag, step in zip(key, path):
+                if step is not None and step != tag:
+                    break
+            else:
+                results.extend(nodes)
+        results.sort(key = lambda node: node.offset)
+        return results
+    
+    def query_first(self, path):
+        "Return the first element at path, or None"
+        results = self.query(path)
+        if len(results) == 0:
+            return None
+        return results[0]
+
+class TLV_Stream_Decoder(object):
+    """Push style TLV parser for data that arrives in chunks, e.g. as the responses
+    to consecutive READ BINARY commands. Call feed() with each chunk; it returns 
+    the elements that have been completed by that chunk, as TLV_Node objects. Nested
+    elements are returned as soon as they are complete, before the elements that 
+    contain them. total_length is set as soon as the header of the first element
+    has been seen.
+    With length_only set only the header of the first element is parsed, no elements
+    are returned and no data is kept: use this if you only need total_length, remaining
+    and complete."""
+    
+    ## Longest header that is still waited for, anything longer is not a sane TLV header
+    MAX_HEADER_LENGTH = 32
+    
+    def __init__(self, length_only = False):
+        self.length_only = length_only
+        self.total_length = None
+        self.received = 0
+        self._pos = 0
+        ## Open constructed elements: (ber_class, constructed, tag, length, offset, value_offset, end)
+        self._open = []
+        ## The chunks that are still needed, and the offsets at which they start
+        self._chunks = []
+        self._starts = []
+    
+    def _get_remaining(self):
+        if self.total_length is None:
+            return None
+        return max(self.total_length - self.received, 0)
+    remaining = property(_get_remaining, None, None,
+        "Number of bytes still missing from the first element, or None if not known yet")
+    
+    complete = property(lambda self: self.total_length is not None and self.received >= self.total_length,
+        None, None, "True when the first element has been received completely")
+    
+    def _get(self, start, end):
+        "Return the received data from offset start to offset end"
+        index = max(bisect.bisect_right(self._starts, start) - 1, 0)
+        result = []
+        while index < len(self._chunks) and start < end:
+            chunk_start = self._starts[index]
+            part = self._chunks[index][start-chunk_start:end-chunk_start]
+            result.append(part)
+            start = start + len(part)
+            index = index + 1
+        return "".join(result)
+    
+    def _node(self, ber_class, constructed, tag, length, offset, value_offset, end):
+        return TLV_Node(self._get(offset, end), ber_class, constructed, tag, length, 
+            0, value_offset - offset, end - offset)
+    
+    def _discard(self, needed):
+        "Drop all chunks that end before offset needed"
+        count = 0
+        while count < len(self._chunks) and self._starts[count] + len(self._chunks[count]) <= needed:
+            count = count + 1
+        del self._chunks[:count]
+        del self._starts[:count]
+    
+    def feed(self, data):
+        "Add the next chunk of data. Returns a list of the elements that are now complete."
+        if self.length_only and self.total_length is not None:
+            self.received = self.received + len(data)
+            return []
+        
+        if len(data) > 0:
+            self._chunks.append(data)
+            self._starts.append(self.received)
+            self.received = self.received + len(data)
+        
+        pos, pending = self._pos, self._open
+        available = self.received
+        result = []
+        
+        while True:
+            while len(pending) > 0 and pos >= pending[-1][-1]:
+                result.append( self._node(*pending.pop()) )
+            
+            if len(pending) > 0:
+                end = pending[-1][-1]
+            else:
+                end = None
+            
+            if pos >= available:
+                break
+            
+            header = self._get(pos, min(pos + self.MAX_HEADER_LENGTH, available))
+            skip = len(header) - len(header.lstrip("\x00\xFF"))
+            if skip > 0:
+                pos = pos + skip
+                continue
+            
+            try:
+                ber_class, constructed, tag, length, value_pos = tlv_read_header(header, 0, end is not None and end - pos or None)
+            except IndexError:
+                if (end is not None and available >= end) or len(header) >= self.MAX_HEADER_LENGTH:
+                    raise
+                break ## Header not complete yet
+            value_pos = pos + value_pos
+            
+            if self.total_length is None:
+                self.total_length = value_pos + length
+                if self.length_only:
+                    self._chunks, self._starts = [], []
+                    break
+            
+            stop = value_pos + length
+            if end is not None:
+                stop = min(stop, end)
+            
+            if constructed:
+                pending.append( (ber_class, constructed, tag, length, pos, value_pos, stop) )
+                pos = value_pos
+            elif stop <= available:
+                result.append( self._node(ber_class, constructed, tag, length, pos, value_pos, stop) )
+                pos = stop
+            else:
+                break ## Value not complete yet
+        
+        self._pos = pos
+        if len(pending) > 0:
+            self._discard(pending[0][4])
+        else:
+            self._discard(pos)
+        return result
+
 def pack(tlv_data, recalculate_length = False):
     result = []
     
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""Micro-benchmark for the APDU classes in utils.py.
+
+Measures the operations that are done for every command sent to a card:
+building a command from a template, rendering it, and parsing the response.
+Run as: python apdu_benchmark.py [number of iterations]"""
+
+import sys, timeit
+
+SETUP = """
+import utils
+TEMPLATE = utils.C_APDU(ins=0xb0, le=0)
+SELECT = utils.C_APDU(ins=0xa4, p1=0x02, p2=0x0c, data="\\x01\\x1e")
+COMMAND = TEMPLATE.render()
+RESPONSE = "\\x00" * 0xdf + "\\x90\\x00"
+"""
+
+CASES = [
+    ("C_APDU from binary string", "utils.C_APDU(COMMAND)"),
+    ("C_APDU from template + kwargs", "utils.C_APDU(TEMPLATE, p1=0x12, p2=0x34)"),
+    ("C_APDU from template with data", "utils.C_APDU(SELECT, data='\\x50\\x15')"),
+    ("C_APDU with_params", "TEMPLATE.with_params(p1=0x12, p2=0x34)"),
+    ("C_APDU with_params with data", "SELECT.with_params(data='\\x50\\x15')"),
+    ("C_APDU from fields", "utils.C_APDU(cla=0, ins=0xb0, p1=0, p2=0, le=0)"),
+    ("C_APDU render", "SELECT.render()"),
+    ("C_APDU field access", "SELECT.cla, SELECT.ins, SELECT.p1, SELECT.p2, SELECT.lc, SELECT.le"),
+    ("R_APDU from binary string", "utils.R_APDU(RESPONSE)"),
+    ("R_APDU sw", "utils.R_APDU(RESPONSE).sw"),
+]
+
+def run(number):
+    print "%-34s %12s" % ("", "us per call")
+    for name, statement in CASES:
+        best = min(timeit.repeat(statement, SETUP, repeat = 3, number = number))
+        print "%-34s %12.2f" % (name, best / number * 1e6)
+
+if __name__ == "__main__":
+    number = 20000
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+    run(number)
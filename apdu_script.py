@@ -0,0 +1,188 @@
+"""Precompiled APDU scripts.
+
+compile_script() turns a text script, as accepted by the run_script shell
+command, into a compact binary file. run() executes such a file on a card
+in a tight loop: the file is memory-mapped and the APDUs are sent without
+going through the shell's command parser and without hex decoding.
+
+Text format: One command per line, lines starting with // or # are comments.
+Lines that start with a shell command are kept as command lines and executed
+through the shell at run time, like run_script would. Of the remaining lines,
+plain or fancy APDUs are compiled to binary APDUs and everything else is kept as
+a command line too. Any line may end with "=> SW" to give the expected status word, as four
+hex digits of which each may be x for "don't care", e.g. "00 a4 00 00 => 61xx".
+Without an expected SW the card driver's check_sw() decides.
+
+Binary format: The magic string, then a sequence of records. Each record starts
+with the header RECORD_HEADER (type, expected SW, SW mask, payload length)
+followed by the payload:
+    RECORD_APDU:    the binary command APDU
+    RECORD_COMMAND: a shell command line
+A SW mask of 0 means that check_sw() is used."""
+
+import struct, mmap, binascii, re, utils
+
+MAGIC = "CFSCRIPT\x01"
+RECORD_HEADER = ">cHHI"
+RECORD_HEADER_LENGTH = struct.calcsize(RECORD_HEADER)
+
+RECORD_APDU = "A"
+RECORD_COMMAND = "C"
+
+## The command name at the start of a line, as in Shell.parse_and_execute()
+_commandregex = re.compile(r'\s*(\w+)')
+
+def parse_expected_sw(text):
+    "Parse an expected SW like 9000 or 61xx into a tuple (value, mask)"
+    text = "".join(text.split()).lower()
+    if len(text) != 4:
+        raise ValueError, "Expected SW must be four hex digits (or x), not %r" % text
+    value = mask = 0
+    for char in text:
+        value, mask = value << 4, mask << 4
+        if char != "x":
+            value, mask = value | int(char, 16), mask | 0xf
+    return value, mask
+
+def split_expected_sw(line):
+    """Split an optional "=> SW" from the end of a script line. Returns a tuple 
+    (line, value, mask), with a mask of 0 if there was no expected SW."""
+    if "=>" not in line:
+        return line, 0, 0
+    line, expected = line.rsplit("=>", 1)
+    value, mask = parse_expected_sw(expected)
+    return line.strip(), value, mask
+
+def check_sw(card, sw, value, mask):
+    "Check sw against the expected value and mask, or with card.check_sw() if mask is 0"
+    if mask != 0:
+        return ((ord(sw[0]) << 8 | ord(sw[1])) & mask) == value
+    return card.check_sw(sw)
+
+def compile_line(line, commands = ()):
+    """Compile one line of a text script into a record tuple (type, sw, mask, payload).
+    commands are the names of the shell commands (e.g. the shell's command mapping):
+    lines starting with one of these are never compiled to APDUs, even if they
+    look like hex (e.g. "cd 3f00"). Returns None for empty lines and comments."""
+    line = line.strip()
+    if line == "" or line[:2] == "//" or line[:1] == "#":
+        return None
+    
+    line, sw, mask = split_expected_sw(line)
+    
+    match = _commandregex.match(line)
+    if match and match.group(1) in commands:
+        return RECORD_COMMAND, sw, mask, line
+    
+    if utils.C_APDU._apduregex.match(line):
+        return RECORD_APDU, sw, mask, binascii.a2b_hex("".join(line.split()))
+    
+    try:
+        apdu = utils.C_APDU.parse_fancy_apdu(False, line)
+    except ValueError:
+        apdu = None
+    if apdu is not None and len(apdu.marks) == 0:
+        return RECORD_APDU, sw, mask, apdu.render()
+    
+    ## Shell commands, and fancy APDUs whose marks are needed by secure messaging
+    return RECORD_COMMAND, sw, mask, line
+
+def compile_script(lines, fp, commands = ()):
+    """Compile the lines of a text script and write the binary form to the file
+    object fp. commands are the names of the shell commands, see compile_line().
+    Returns the number of records written."""
+    fp.write(MAGIC)
+    count = 0
+    for number, line in enumerate(lines):
+        try:
+            record = compile_line(line, commands)
+        except ValueError, e:
+            raise ValueError, "Line %i: %s" % (number + 1, e)
+        if record is None:
+            continue
+        type, sw, mask, payload = record
+        fp.write( struct.pack(RECORD_HEADER, type, sw, mask, len(payload)) )
+        fp.write(payload)
+        count = count + 1
+    return count
+
+def is_compiled_script(filename):
+    "Return True if filename is a compiled script"
+    fp = file(filename, "rb")
+    try:
+        return fp.read(len(MAGIC)) == MAGIC
+    finally:
+        fp.close()
+
+class Compiled_Script(object):
+    "A compiled script file, mapped into memory. Iterate over it to get the records."
+    
+    def __init__(self, filename):
+        fp = file(filename, "rb")
+        try:
+            if fp.read(len(MAGIC)) != MAGIC:
+                raise ValueError, "Not a compiled APDU script"
+            self.data = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            fp.close()
+    
+    def __iter__(self):
+        data, unpack_from = self.data, struct.unpack_from
+        pos, end = len(MAGIC), len(self.data)
+        while pos < end:
+            if pos + RECORD_HEADER_LENGTH > end:
+                raise ValueError, "Truncated compiled script"
+            type, sw, mask, length = unpack_from(RECORD_HEADER, data, pos)
+            pos = pos + RECORD_HEADER_LENGTH
+            if pos + length > end:
+                raise ValueError, "Truncated compiled script"
+            yield type, sw, mask, data[pos:pos+length]
+            pos = pos + length
+    
+    def close(self):
+        self.data.close()
+
+def run(card, script, execute_command, sw_failed = None):
+    """Execute a compiled script on card. execute_command(line) is called for
+    command records. When a SW doesn't match, sw_failed(sw) is called; the
+    script is aborted when it returns False (or when sw_failed is None).
+    Returns a tuple (number of records executed, number of failed SWs)."""
+    C_APDU = utils.C_APDU
+    send_apdu, card_check_sw = card.send_apdu, card.check_sw
+    executed = failed = 0
+    
+    for type, expected, mask, payload in script:
+        executed = executed + 1
+        if type == RECORD_APDU:
+            sw = send_apdu(C_APDU(payload)).sw
+        else:
+            card.sw_changed = False
+            execute_command(payload)
+            if not card.sw_changed:
+                continue
+            sw = card.last_sw
+        
+        if mask != 0:
+            ok = ((ord(sw[0]) << 8 | ord(sw[1])) & mask) == expected
+        else:
+            ok = card_check_sw(sw)
+        
+        if not ok:
+            failed = failed + 1
+            if sw_failed is None or sw_failed(sw) is False:
+                break
+    
+    return executed, failed
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 3:
+        print >>sys.stderr, "Usage: %s script.txt compiled-script" % sys.argv[0]
+        print >>sys.stderr, "Shell commands are not known here, use the shell's compile_script command for scripts that use them"
+        sys.exit(1)
+    infile, outfile = file(sys.argv[1]), file(sys.argv[2], "wb")
+    try:
+        print "%i records written" % compile_script(infile, outfile)
+    finally:
+        infile.close()
+        outfile.close()
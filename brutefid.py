@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: iso-8859-1 -*-
 
-import utils, cards, TLV_utils, sys, binascii, time, traceback, smartcard, readers
+import utils, cards, TLV_utils, sys, binascii, time, traceback, readers
 
 OPTIONS = "m:x:dD"
 LONG_OPTIONS = ["min-fid", "max-fid", "with-dirs", "dump-contents"]
@@ -23,7 +23,8 @@ dump_contents = False
 
 def dump(data):
     print "Dump following (%i bytes)" % (len(data))
-    print utils.hexdump(data)
+    for line in utils.hexdump_lines(data):
+        print line
     try:
         print "Trying TLV parse:"
         print TLV_utils.decode(data, tags=card.TLV_OBJECTS, context = card.DEFAULT_CONTEXT)
@@ -93,54 +94,50 @@ if __name__ == "__main__":
                 status = status + ", files: %2i)" % len(results_file)
             loop = loop + 1
             
-            if with_dirs:
-                try:
-                    result = card.change_dir(data)
-                except smartcard.Exceptions.CardConnectionException:
-                    time.sleep(1)
+            card.begin_transaction()
+            try:
+                if with_dirs:
                     result = card.change_dir(data)
-                if card.check_sw(result.sw):
-                    results_dir[fid] = result
-                    card.change_dir()
-                    if top_level is not None:
-                        for e in top_level: 
-                            if len(e) == 2:
-                                card.change_dir(e)
-                            else:
-                                card.select_application(e)
+                    if card.check_sw(result.sw):
+                        results_dir[fid] = result
+                        card.change_dir()
+                        if top_level is not None:
+                            for e in top_level: 
+                                if len(e) == 2:
+                                    card.change_dir(e)
+                                else:
+                                    card.select_application(e)
+                    
+                    print >>sys.stderr, "\rDir  %04X -> %02X%02X %s                      " % (fid, result.sw1, result.sw2, status),
                 
-                print >>sys.stderr, "\rDir  %04X -> %02X%02X %s                      " % (fid, result.sw1, result.sw2, status),
-            
-            try:
-                result = card.open_file(data)
-            except smartcard.Exceptions.CardConnectionException:
-                time.sleep(1)
                 result = card.open_file(data)
-            if card.check_sw(result.sw):
-                results_file[fid] = result
-                
-                if dump_contents:
-                    contents, sw = card.read_binary_file()
-                    contents_result = [sw]
-                    if sw == '\x69\x81': # Command incompatible with file structure, retry read_record
-                        # FIXME this logic for reading records is not correct
-                        print >>sys.stderr, "\rFile %04X -> %02X%02X %s  Reading records...  " % (fid, result.sw1, result.sw2, status),
-                        records = {}
-                        for i in range(256):
-                            if i%STATUS_INTERVAL == 0:
-                                print >>sys.stderr, "\rFile %04X -> %02X%02X %s  Reading records...  %s" % (fid, result.sw1, result.sw2, status, 
-                                    SPINNER[ (i/STATUS_INTERVAL) % len(SPINNER) ],
-                                ),
-                            records[i] = card.read_record(i, 4, 0)
-                        contents_result.append(records)
-                    elif sw == '\x69\x82': # Security status not satisfied
-                        pass
-                    elif sw == '\x90\x00': # Command execution successful
-                        contents_result.append(contents)
-                    elif len(contents) > 0: # Something was returned, assume successful execution
-                        contents_result.append(contents)
+                if card.check_sw(result.sw):
+                    results_file[fid] = result
                     
-                    contents_file[fid] = contents_result
+                    if dump_contents:
+                        contents, sw = card.read_binary_file()
+                        contents_result = [sw]
+                        if sw == '\x69\x81': # Command incompatible with file structure, retry read_record
+                            # FIXME this logic for reading records is not correct
+                            print >>sys.stderr, "\rFile %04X -> %02X%02X %s  Reading records...  " % (fid, result.sw1, result.sw2, status),
+                            records = {}
+                            for i in range(256):
+                                if i%STATUS_INTERVAL == 0:
+                                    print >>sys.stderr, "\rFile %04X -> %02X%02X %s  Reading records...  %s" % (fid, result.sw1, result.sw2, status, 
+                                        SPINNER[ (i/STATUS_INTERVAL) % len(SPINNER) ],
+                                    ),
+                                records[i] = card.read_record(i, 4, 0)
+                            contents_result.append(records)
+                        elif sw == '\x69\x82': # Security status not satisfied
+                            pass
+                        elif sw == '\x90\x00': # Command execution successful
+                            contents_result.append(contents)
+                        elif len(contents) > 0: # Something was returned, assume successful execution
+                            contents_result.append(contents)
+                        
+                        contents_file[fid] = contents_result
+            finally:
+                card.end_transaction()
             
             print >>sys.stderr, "\rFile %04X -> %02X%02X %s                      " % (fid, result.sw1, result.sw2, status),
     except (SystemExit, KeyboardInterrupt):
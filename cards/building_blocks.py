@@ -99,32 +99,82 @@ class Card_with_read_binary:
     DATA_UNIT_SIZE=1
     HEXDUMP_LINELEN=16
     
-    def read_binary_file(self, offset = 0):
+    ## Set to True or False to override the detection of extended length support from the ATR
+    EXTENDED_LENGTH = None
+    ## Le for one READ BINARY, resp. maximum Lc for one UPDATE BINARY, when extended length is used
+    EXTENDED_READ_SIZE = 0x1000
+    EXTENDED_WRITE_SIZE = 0x1000
+    _extended_length = None
+    
+    def has_extended_length(self):
+        """Return True if READ BINARY and UPDATE BINARY should use extended Le/Lc fields.
+        Unless set in EXTENDED_LENGTH this is decided from the card capabilities in the ATR.
+        If the card rejects an extended APDU with "wrong length" it is turned off again."""
+        if self._extended_length is None:
+            if self.EXTENDED_LENGTH is not None:
+                self._extended_length = self.EXTENDED_LENGTH
+            else:
+                self._extended_length = utils.has_extended_length(self.get_atr())
+        return self._extended_length
+    
+    def _is_wrong_length(self, result):
+        ## A card that doesn't understand extended APDUs will most probably answer "wrong length"
+        return len(result.data) == 0 and result.sw == "\x67\x00"
+    
+    def read_binary_file(self, offset = 0, tlv = False):
         """Read from the currently selected EF.
-        Repeat calls to READ BINARY as necessary to get the whole EF."""
+        Repeat calls to READ BINARY as necessary to get the whole EF.
+        Set tlv if the file is known to contain a TLV structure: the length from the
+        first TLV header is then used to size the last READ BINARY and to stop exactly
+        at the end of the structure, without reading until the card signals an error."""
         
         if offset >= 1<<15:
             raise ValueError, "offset is limited to 15 bits"
         contents = ""
         had_one = False
+        if tlv:
+            decoder = TLV_utils.TLV_Stream_Decoder(length_only = True)
         
-        self.last_size = -1
-        while True:
-            command = C_APDU(self.APDU_READ_BINARY, p1 = offset >> 8, p2 = (offset & 0xff))
-            result = self.send_apdu(command)
-            if len(result.data) > 0:
-                contents = contents + result.data
-                offset = offset + (len(result.data) / self.DATA_UNIT_SIZE)
-            
-            if self.last_size == len(contents):
-                break
-            else:
-                self.last_size = len(contents)
-            
-            if not self.check_sw(result.sw):
-                break
-            else:
-                had_one = True
+        self.begin_transaction()
+        try:
+            self.last_size = -1
+            while True:
+                command = self.APDU_READ_BINARY.with_params(p1 = offset >> 8, p2 = (offset & 0xff))
+                extended = self.has_extended_length()
+                if extended:
+                    command.Le = self.EXTENDED_READ_SIZE
+                    command.Ext = True
+                if tlv and decoder.remaining is not None:
+                    if decoder.remaining < (command.Le or 256):
+                        command.Le = decoder.remaining
+                result = self.send_apdu(command)
+                if extended and self._is_wrong_length(result):
+                    self._extended_length = False
+                    continue
+                
+                if len(result.data) > 0:
+                    contents = contents + result.data
+                    offset = offset + (len(result.data) / self.DATA_UNIT_SIZE)
+                    if tlv:
+                        try:
+                            decoder.feed(result.data)
+                        except IndexError:
+                            tlv = False ## No sane TLV header at the start of the file, read to the end of the file
+                
+                if self.last_size == len(contents):
+                    break
+                else:
+                    self.last_size = len(contents)
+                
+                if not self.check_sw(result.sw):
+                    break
+                else:
+                    had_one = True
+                
+                if tlv and decoder.complete:
+                    break
+        finally:
+            self.end_transaction()
         
         if had_one: ## If there was at least one successful pass, ignore any error SW. It probably only means "end of file"
             self.sw_changed = False
@@ -132,11 +182,53 @@ class Card_with_read_binary:
         
         return contents, result.sw
     
+    def write_binary_file(self, data, offset = 0):
+        """Write data to the currently selected EF, starting at offset.
+        Repeat calls to UPDATE BINARY as necessary. Returns the status word of the
+        last command, stops at the first error."""
+        
+        if offset + len(data) / self.DATA_UNIT_SIZE > 1<<15:
+            raise ValueError, "offset is limited to 15 bits"
+        
+        pos = 0
+        result = None
+        self.begin_transaction()
+        try:
+            while pos < len(data):
+                extended = self.has_extended_length()
+                if extended:
+                    size = self.EXTENDED_WRITE_SIZE
+                else:
+                    size = 0xff
+                size = size - (size % self.DATA_UNIT_SIZE)
+                
+                command = self.APDU_UPDATE_BINARY.with_params(p1 = offset >> 8, p2 = (offset & 0xff),
+                    data = data[pos:pos+size])
+                if extended:
+                    command.Ext = True
+                result = self.send_apdu(command)
+                if extended and self._is_wrong_length(result):
+                    self._extended_length = False
+                    continue
+                
+                if not self.check_sw(result.sw):
+                    break
+                
+                pos = pos + size
+                offset = offset + size / self.DATA_UNIT_SIZE
+        finally:
+            self.end_transaction()
+        
+        if result is None:
+            return None
+        return result.sw
+    
     def cmd_cat(self):
         "Print a hexdump of the currently selected file (e.g. consecutive READ BINARY)"
         contents, sw = self.read_binary_file()
         self.last_result = R_APDU(contents + self.last_sw)
-        print utils.hexdump(contents,linelen=self.HEXDUMP_LINELEN)
+        for line in utils.hexdump_lines(contents, linelen=self.HEXDUMP_LINELEN):
+            print line
     
     COMMANDS = {
         "cat": cmd_cat,
@@ -20,6 +20,9 @@ class Cyberflex_Card(Java_Card):
     APDU_EXTERNAL_AUTHENTICATE = C_APDU('\x84\x82\x00\x00')
     APDU_GET_STATUS = C_APDU('\x84\xF2\x00\x00\x02\x4f\x00')
     APDU_DELETE = C_APDU('\x84\xe4\x00\x00')
+    SW_MORE_DATA = "\x63\x10"
+    ## DELETE, INSTALL, LOAD, SET STATUS
+    REGISTRY_CHANGING_INS = (0xe4, 0xe6, 0xe8, 0xf0)
     DRIVER_NAME = ["Cyberflex"]
     
     ATRS = [ 
@@ -61,10 +64,14 @@ class Cyberflex_Card(Java_Card):
         self.session_key_mac = None
         self.last_mac = None
         self.secure_channel_state = SECURE_CHANNEL_NONE
+        self._registry = {}
     
     def before_send(self, apdu):
         """Will be called by send_apdu before sending a command APDU.
         Is responsible for authenticating/encrypting commands when needed."""
+        if apdu.ins in self.REGISTRY_CHANGING_INS:
+            self.clear_registry()
+        
         if apdu.cla == 0x84:
             ## Need security
             
@@ -116,38 +123,47 @@ class Cyberflex_Card(Java_Card):
         self.session_key_enc = None
         self.session_key_mac = None
         
-        result = self.send_apdu(apdu)
-        if not self.check_sw(result.sw):
-            raise Exception, "Statusword after InitializeUpdate was %s. Warning: No successful ExternalAuthenticate; keyset might be locked soon" % binascii.b2a_hex(result[-2:])
-        
-        card_challenge = result.data[12:20]
-        card_cryptogram = result.data[20:28]
-        
-        self.session_key_enc = crypto_utils.get_session_key(
-            self.keyset[KEY_AUTH], host_challenge, card_challenge)
-        self.session_key_mac = crypto_utils.get_session_key(
-            self.keyset[KEY_MAC], host_challenge, card_challenge)
-        
-        if not crypto_utils.verify_card_cryptogram(self.session_key_enc,
-            host_challenge, card_challenge, card_cryptogram):
-            raise Exception, "Validation error, card not authenticated. Warning: No successful ExternalAuthenticate; keyset might be locked soon"
-        
-        host_cryptogram = crypto_utils.calculate_host_cryptogram(
-            self.session_key_enc, card_challenge, host_challenge)
-        
-        apdu = C_APDU(self.APDU_EXTERNAL_AUTHENTICATE,
-            p1 = security_level, p2 = 0,
-            data = host_cryptogram)
+        self.begin_transaction()
+        try:
+            result = self.send_apdu(apdu)
+            if not self.check_sw(result.sw):
+                raise Exception, "Statusword after InitializeUpdate was %s. Warning: No successful ExternalAuthenticate; keyset might be locked soon" % binascii.b2a_hex(result[-2:])
             
-        self.secure_channel_state = SECURE_CHANNEL_MAC
-        result = self.send_apdu(apdu)
-        self.secure_channel_state = security_level
-        
-        if not self.check_sw(result.sw):
-            self.secure_channel_state = SECURE_CHANNEL_NONE
-            raise Exception, "Statusword after ExternalAuthenticate was %s. Warning: No successful ExternalAuthenticate; keyset might be locked soon" % binascii.b2a_hex(result[-2:])
-        
-        return True
+            card_challenge = result.data[12:20]
+            card_cryptogram = result.data[20:28]
+            
+            self.session_key_enc = crypto_utils.get_session_key(
+                self.keyset[KEY_AUTH], host_challenge, card_challenge)
+            self.session_key_mac = crypto_utils.get_session_key(
+                self.keyset[KEY_MAC], host_challenge, card_challenge)
+            
+            if not crypto_utils.verify_card_cryptogram(self.session_key_enc,
+                host_challenge, card_challenge, card_cryptogram):
+                raise Exception, "Validation error, card not authenticated. Warning: No successful ExternalAuthenticate; keyset might be locked soon"
+            
+            host_cryptogram = crypto_utils.calculate_host_cryptogram(
+                self.session_key_enc, card_challenge, host_challenge)
+            
+            apdu = C_APDU(self.APDU_EXTERNAL_AUTHENTICATE,
+                p1 = security_level, p2 = 0,
+                data = host_cryptogram)
+                
+            self.secure_channel_state = SECURE_CHANNEL_MAC
+            result = self.send_apdu(apdu)
+            self.secure_channel_state = security_level
+            
+            if not self.check_sw(result.sw):
+                self.secure_channel_state = SECURE_CHANNEL_NONE
+                raise Exception, "Statusword after ExternalAuthenticate was %s. Warning: No successful ExternalAuthenticate; keyset might be locked soon" % binascii.b2a_hex(result[-2:])
+            
+            self.set_session_step("authentication", self.open_secure_channel, keyset_version, key_index, security_level)
+            return True
+        finally:
+            self.end_transaction()
+    
+    def session_lost(self):
+        self.secure_channel_state = SECURE_CHANNEL_NONE
+        self.clear_registry()
     
     def select_application(self, aid):
         result = Java_Card.select_application(self, aid)
@@ -173,6 +189,37 @@ class Cyberflex_Card(Java_Card):
                 p1 = reference_control)
             )
     
+    def get_registry(self, reference_control=0x20, refresh=False):
+        """Return the part of the card registry selected by reference_control 
+        (see get_status()) as a list of utils.Registry_Entry objects. Sends as many
+        GetStatus commands as needed while the card answers 6310 (more data).
+        The result is cached until an APDU that changes the registry (DELETE, 
+        INSTALL, LOAD, SET STATUS) is sent or the session is lost."""
+        if not refresh and self._registry.has_key(reference_control):
+            return self._registry[reference_control]
+        
+        entries = []
+        self.begin_transaction()
+        try:
+            p2 = 0x00
+            while True:
+                result = self.send_apdu(self.APDU_GET_STATUS.with_params(p1 = reference_control, p2 = p2))
+                if result.sw != self.SW_MORE_DATA and not self.check_sw(result.sw):
+                    raise ValueError, "GetStatus failed with SW %s" % binascii.b2a_hex(result.sw)
+                utils.parse_registry(result.data, entries)
+                if result.sw != self.SW_MORE_DATA:
+                    break
+                p2 = 0x01 ## Get next occurrence(s)
+        finally:
+            self.end_transaction()
+        
+        self._registry[reference_control] = entries
+        return entries
+    
+    def clear_registry(self):
+        "Forget the cached registry contents"
+        self._registry = {}
+    
     def delete(self, aid):
         if aid[:5] == DEFAULT_CARD_MANAGER_AID[:5]:
             print "Cowardly refusing to delete the card manager."
@@ -189,11 +236,11 @@ class Cyberflex_Card(Java_Card):
         aid = binascii.a2b_hex("".join(aid.split()))
         self.delete(aid)
     
-    def cmd_status(self, reference_control = "0x20"):
-        """Execute a GetStatus command and return the result."""
+    def cmd_status(self, reference_control = "0x20", refresh = None):
+        """Print the card registry (GetStatus). Cached results are used unless refresh is given."""
         reference_control = int(reference_control, 0)
-        result = self.get_status(reference_control)
-        utils.parse_status(result.data)
+        for entry in self.get_registry(reference_control, refresh is not None):
+            print entry.format()
     
     def cmd_secure(self, keyset_version=None, key_index=None, security_level=None):
         """Open a secure channel. 
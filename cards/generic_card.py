@@ -137,9 +137,11 @@ class Card:
         self.last_apdu = None
         self.last_sw = None
         self.last_result = None
+        self._last_tlv_index = None
         self.sw_changed = False
         self._last_start = None
         self.last_delta = None
+        self._session_steps = []
     
     def post_merge(self):
         ## Called after cards.__init__.Cardmultiplexer._merge_attributes
@@ -163,8 +165,22 @@ class Card:
         # FIXME
         raise NotImplementedException
     
+    def get_tlv_index(self, data):
+        "Return a TLV_utils.TLV_Index for data. The index of the last call is reused if data is the same."
+        if self._last_tlv_index is None or self._last_tlv_index.root.data != data:
+            self._last_tlv_index = TLV_utils.lazy_unpack(data).get_index()
+        return self._last_tlv_index
+    
     def cmd_parsetlv(self, start = None, end = None):
-        "Decode the TLV data in the last response, start and end are optional"
+        """Decode the TLV data in the last response, start and end are optional.
+        Instead of start and end a path can be given, e.g. 77/30/A0 or /5F1F (hex tags,
+        * for any tag): then only the elements at that path are decoded."""
+        if start is not None and "/" in start:
+            for node in self.get_tlv_index(self.last_result.data).query(start):
+                print "%s at offset %i:" % (TLV_utils.format_tlv_path(node.get_path()), node.offset)
+                print TLV_utils.decode_node(node, tags=self.TLV_OBJECTS, context = self.DEFAULT_CONTEXT)
+            return
+        
         lastlen = len(self.last_result.data)
         if start is not None:
             start = (lastlen + (int(start,0) % lastlen) ) % lastlen
@@ -213,17 +229,23 @@ class Card:
             print "<< " + utils.hexdump(result_binary, indent = 3)
         return result
     
+    def _count_event(self, event):
+        if hasattr(self.reader, "get_statistics"):
+            self.reader.get_statistics().count(event)
+    
     def _send_with_retry(self, apdu):
         result = self._real_send(apdu)
         
         if self.check_sw(result.sw, PURPOSE_GET_RESPONSE):
             ## Need to call GetResponse
-            gr_apdu = C_APDU(self.APDU_GET_RESPONSE, le = result.sw2, cla=apdu.cla) # FIXME
-            result = R_APDU(self._real_send(gr_apdu))
+            self._count_event("get_response")
+            gr_apdu = self.APDU_GET_RESPONSE.with_params(le = result.sw2, cla=apdu.cla) # FIXME
+            result = self._real_send(gr_apdu)
         elif self.check_sw(result.sw, PURPOSE_RETRY) and apdu.Le == 0:
             ## Retry with correct Le
-            gr_apdu = C_APDU(apdu, le = result.sw2)
-            result = R_APDU(self._real_send(gr_apdu))
+            self._count_event("retry")
+            gr_apdu = apdu.with_params(le = result.sw2)
+            result = self._real_send(gr_apdu)
         
         return result
     
@@ -234,10 +256,30 @@ class Card:
         self.last_delta = None
         self._last_start = time.time()
         
-        if hasattr(self, "before_send"):
-            apdu = self.before_send(apdu)
+        attempts = 0
+        command = apdu
+        saved = None
+        if hasattr(self, "before_send") and self.AUTO_RECONNECT > 0 and not self._replaying:
+            ## before_send may modify the APDU fields in place (e.g. secure messaging), 
+            ##   remember them in case the command must be processed again for a retry
+            saved = apdu.save_fields()
         
-        result = self._send_with_retry(apdu)
+        while True:
+            if hasattr(self, "before_send"):
+                command = self.before_send(command)
+            
+            try:
+                result = self._send_with_retry(command)
+                break
+            except getattr(self.reader, "CONNECTION_ERRORS", ()):
+                if self._replaying or attempts >= self.AUTO_RECONNECT:
+                    raise
+                attempts = attempts + 1
+                if not self.reconnect():
+                    raise
+                if saved is not None:
+                    apdu.restore_fields(saved)
+                command = apdu
         
         if hasattr(self, "after_send"):
             result = self.after_send(result)
@@ -253,6 +295,111 @@ class Card:
         self.last_result = result
         return result
     
+    ## Number of times send_apdu() transparently reconnects to the card (and restores
+    ##   the session state) when the connection was lost, and how long to wait for the 
+    ##   card to come back each time
+    AUTO_RECONNECT = 2
+    RECONNECT_TIMEOUT = 5.0
+    _replaying = False
+    
+    def set_session_step(self, key, function, *args, **kwargs):
+        """Remember that function(*args, **kwargs) must be repeated to restore the
+        session after a reconnect. Steps are repeated in the order they were set.
+        Setting a key again replaces its step and drops all steps that were set after
+        it (e.g. selecting another application invalidates an authentication)."""
+        if self._replaying:
+            return
+        for index, step in enumerate(self._session_steps):
+            if step[0] == key:
+                del self._session_steps[index:]
+                break
+        self._session_steps.append( (key, function, args, kwargs) )
+    
+    def clear_session_state(self):
+        "Forget all session state, e.g. after the card has been reset"
+        self._session_steps = []
+        if hasattr(self, "clear_selection"):
+            self.clear_selection()
+    
+    def begin_transaction(self, timeout = None):
+        """Start an exclusive (nestable) transaction on the reader, see 
+        readers.Smartcard_Reader.begin_transaction(). Use with try/finally:
+            card.begin_transaction()
+            try:
+                ...
+            finally:
+                card.end_transaction()
+        If the card can't be locked because the connection was lost, the card is
+        reconnected (at most AUTO_RECONNECT times) like in send_apdu()."""
+        attempts = 0
+        while True:
+            try:
+                self.reader.begin_transaction(timeout)
+                return
+            except getattr(self.reader, "CONNECTION_ERRORS", ()):
+                if self._replaying or attempts >= self.AUTO_RECONNECT:
+                    raise
+                attempts = attempts + 1
+                if not self.reconnect():
+                    raise
+    
+    def end_transaction(self):
+        self.reader.end_transaction()
+    
+    def resend_apdu(self, binary):
+        "Send the APDU given as binary string again, for use as a session step"
+        return self.send_apdu(C_APDU(binary))
+    
+    def restore_session(self):
+        """Repeat the remembered session steps, then restore the file selection.
+        Called by reconnect()."""
+        self.begin_transaction()
+        self._replaying = True
+        try:
+            for key, function, args, kwargs in list(self._session_steps):
+                function(*args, **kwargs)
+            if hasattr(self, "restore_selection"):
+                self.restore_selection()
+        finally:
+            self._replaying = False
+            self.end_transaction()
+    
+    def reconnect(self):
+        """Re-establish the connection to the card and restore the session state.
+        Returns False if the card did not come back within RECONNECT_TIMEOUT seconds."""
+        if not self.reader.reconnect(self.RECONNECT_TIMEOUT):
+            return False
+        self._count_event("reconnect")
+        
+        ## Secure messaging state is lost with the connection, the drivers reset it here
+        if hasattr(self, "session_lost"):
+            self.session_lost()
+        
+        ## The replayed commands must not change the timing of the command that is
+        ##   being retried, last_delta should cover all attempts and the reconnect
+        last_start, last_delta = self._last_start, self.last_delta
+        try:
+            self.restore_session()
+        finally:
+            self._last_start, self.last_delta = last_start, last_delta
+        return True
+    
+    def send_apdu_async(self, apdu):
+        """Like send_apdu() (including before_send/after_send processing), but executed 
+        on the reader's executor thread. Returns an Async_Result for the R_APDU.
+        All asynchronous calls for one card are executed in the order they were issued.
+        Each call runs in its own transaction, so it can't interleave with code on other 
+        threads that uses begin_transaction()/end_transaction() around its commands."""
+        return self.reader.get_executor().submit(self._send_apdu_locked, apdu)
+    
+    def _send_apdu_locked(self, apdu):
+        "send_apdu() in a transaction, for send_apdu_async()"
+        self.begin_transaction()
+        try:
+            return self.send_apdu(apdu)
+        finally:
+            self.end_transaction()
+    
     def check_sw(self, sw, purpose = None):
         if purpose is None: purpose = Card.PURPOSE_SUCCESS
         return self.match_statusword(self.STATUS_MAP[purpose], sw)
@@ -335,6 +482,8 @@ class Card:
     
     def close_card(self):
         "Disconnect from a card"
+        if hasattr(self.reader, "shutdown_executor"):
+            self.reader.shutdown_executor()
         self.reader.disconnect()
         del self.reader
 
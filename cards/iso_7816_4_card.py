@@ -160,6 +160,7 @@ class ISO_7816_4_Card(building_blocks.Card_with_read_binary,Card):
     APDU_SELECT_APPLICATION = C_APDU(ins=0xa4,p1=0x04)
     APDU_SELECT_FILE = C_APDU(ins=0xa4, le=0)
     APDU_READ_BINARY = C_APDU(ins=0xb0,le=0)
+    APDU_UPDATE_BINARY = C_APDU(ins=0xd6)
     APDU_READ_RECORD = C_APDU(ins=0xb2,le=0)
     DRIVER_NAME = ["ISO 7816-4"]
     FID_MF = "\x3f\x00"
@@ -177,11 +178,42 @@ class ISO_7816_4_Card(building_blocks.Card_with_read_binary,Card):
 
     def select_file(self, p1, p2, fid):
         result = self.send_apdu(
-            C_APDU(self.APDU_SELECT_FILE,
+            self.APDU_SELECT_FILE.with_params(
             p1 = p1, p2 = p2,
             data = fid, le = self.SELECT_FILE_LE) )
+        if not self._replaying and self.check_sw(result.sw):
+            self._update_selection(p1, p2, fid)
         return result
     
+    _selection = ()
+    def _update_selection(self, p1, p2, fid):
+        """Keep a short list of the SELECT FILE commands that lead to the current 
+        selection: Selection by absolute path, by DF name or of the MF starts over,
+        selecting a child DF or an EF replaces a previously selected EF, and selecting 
+        the parent DF cancels the selection of a child DF."""
+        if isinstance(p1, str): p1 = ord(p1)
+        if isinstance(p2, str): p2 = ord(p2)
+        selection = list(self._selection)
+        if p1 in (0x00, 0x04, 0x08):
+            selection = []
+        else:
+            while len(selection) > 0 and selection[-1][0] == 0x02:
+                del selection[-1]
+            if p1 == 0x03 and len(selection) > 0 and selection[-1][0] == 0x01:
+                del selection[-1]
+                p1 = None
+        if p1 is not None:
+            selection.append( (p1, p2, fid) )
+        self._selection = tuple(selection)
+    
+    def clear_selection(self):
+        self._selection = ()
+    
+    def restore_selection(self):
+        "Repeat the SELECT FILE commands that lead to the current selection"
+        for p1, p2, fid in self._selection:
+            self.select_file(p1, p2, fid)
+    
     def change_dir(self, fid = None):
         "Change to a child DF. Alternatively, change to MF if fid is None."
         if fid is None:
@@ -218,7 +250,7 @@ class ISO_7816_4_Card(building_blocks.Card_with_read_binary,Card):
     
     def read_record(self, p1 = 0, p2 = 0, le = 0):
         "Read a record from the currently selected file"
-        command = C_APDU(self.APDU_READ_RECORD, p1 = p1, p2 = p2, le = le)
+        command = self.APDU_READ_RECORD.with_params(p1 = p1, p2 = p2, le = le)
         result = self.send_apdu(command)
         return result.data
     
@@ -248,10 +280,13 @@ class ISO_7816_4_Card(building_blocks.Card_with_read_binary,Card):
             print TLV_utils.decode(result.data,tags=self.TLV_OBJECTS)
     
     def select_application(self, aid, le=0, **kwargs):
-        result = self.send_apdu(
-            C_APDU(self.APDU_SELECT_APPLICATION,
-            data = aid, le = le, **kwargs) ) ## FIXME With or without le
+        command = C_APDU(self.APDU_SELECT_APPLICATION,
+            data = aid, le = le, **kwargs) ## FIXME With or without le
+        binary = command.render()
+        result = self.send_apdu(command)
         if self.check_sw(result.sw):
+            self.set_session_step("application", self.resend_apdu, binary)
+            self.clear_selection()
             Application.load_applications(self, aid)
         return result
     
@@ -9,5 +9,5 @@ class Java_Card(Card):
     }
     
     def __init__(self, card = None):
-        Card.__init__(self, card = card)
+        Card.__init__(self, card)
 
@@ -16,7 +16,8 @@ class NFC_Application(Application):
         if self.check_sw(result.sw):
             contents, sw = self.read_binary_file()
             if len(contents) > 0:
-                print utils.hexdump(contents,linelen=self.HEXDUMP_LINELEN)
+                for line in utils.hexdump_lines(contents, linelen=self.HEXDUMP_LINELEN):
+                    print line
                 
                 if len(contents) < 0xf:
                     print "Invalid CC EF, can't parse (too short: 0x%x bytes)" % len(contents)
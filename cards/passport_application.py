@@ -1,7 +1,7 @@
 from generic_application import Application
 import struct, binascii, os, datetime, sys
 from hashlib import sha1
-from utils import hexdump, C_APDU
+from utils import hexdump, C_APDU, compile_fancy_apdu
 from tcos_card import SE_Config, TCOS_Security_Environment
 from generic_card import Card
 from iso_7816_4_card import ISO_7816_4_Card
@@ -37,24 +37,34 @@ class Passport_Security_Environment(TCOS_Security_Environment):
         if (apdu.cla & 0x80 != 0x80) and (apdu.CLA & 0x0C != 0x0C):
             # Transform for SM
             apdu.CLA = apdu.CLA | 0x0C
-            apdu_string = binascii.b2a_hex(apdu.render())
-            new_apdu = [apdu_string[:8]]
-            new_apdu.append("YY")
+            new_apdu = ["{header}YY"]
             
-            if apdu.case() in (3,4):
-                new_apdu.append("87[01")
-                new_apdu.append(binascii.b2a_hex(apdu.data))
-                new_apdu.append("]")
+            case = apdu.case()
+            if case > 4:
+                case = case - 4 ## Extended APDU
             
-            if apdu.case() in (2,4):
-                if apdu.Le == 0:
+            if case in (3,4):
+                new_apdu.append("87[01{data}]")
+            
+            le = ""
+            if case in (2,4):
+                if apdu.Le == 0 and not apdu.Ext:
                     apdu.Le = 0xe7 # FIXME: Probably not the right way
-                new_apdu.append("97(%02x)" % apdu.Le)
+                if apdu.Ext or apdu.Le > 0xff:
+                    le = chr((apdu.Le >> 8) & 0xff) + chr(apdu.Le & 0xff)
+                else:
+                    le = chr(apdu.Le)
+                new_apdu.append("97({le})")
             
-            new_apdu.append("8E()00")
+            if apdu.Ext:
+                new_apdu.append("8E()0000")
+            else:
+                new_apdu.append("8E()00")
             
-            new_apdu_string = "".join(new_apdu)
-            apdu = C_APDU.parse_fancy_apdu(False, new_apdu_string)
+            ## At most eight different templates, compiled once
+            template = compile_fancy_apdu(apdu.Ext, "".join(new_apdu))
+            header = chr(apdu.CLA) + chr(apdu.INS) + chr(apdu.P1) + chr(apdu.P2)
+            apdu = template.instantiate(header = header, data = apdu.data, le = le)
         
         return TCOS_Security_Environment.before_send(self, apdu)
     
@@ -62,7 +72,7 @@ class Passport_Security_Environment(TCOS_Security_Environment):
         if (self.last_vanilla_c_apdu.cla & 0x80 != 0x80) and (self.last_vanilla_c_apdu.CLA & 0x0C != 0x0C):
             # Inject fake response descriptor so that TCOS_Security_Environment.after_send sees the need to authenticate/decrypt
             response_descriptor = "\x99\x00\x8e\x00"
-            if self.last_vanilla_c_apdu.case() in (2,4):
+            if self.last_vanilla_c_apdu.case() in (2,4,6,8):
                 response_descriptor = "\x87\x00" + response_descriptor
             response_descriptor = "\xba" + chr(len(response_descriptor)) + response_descriptor
             
@@ -132,6 +142,14 @@ class Passport_Application(Application):
     
     def cmd_perform_bac(self, mrz2, verbose=1):
         "Perform the Basic Acess Control authentication and establishment of session keys"
+        ## GET CHALLENGE and MUTUAL AUTHENTICATE must not be interleaved with other commands
+        self.begin_transaction()
+        try:
+            self._perform_bac(mrz2, verbose)
+        finally:
+            self.end_transaction()
+    
+    def _perform_bac(self, mrz2, verbose):
         mrz2 = mrz2.upper()
         Kseed = self.derive_seed(mrz2, verbose)
         Kenc = self.derive_key(Kseed, 1)
@@ -210,6 +228,11 @@ class Passport_Application(Application):
             print "ssc     = %s" % hexdump(self.ssc)
         
         self.se = Passport_Security_Environment(self)
+        self.set_session_step("authentication", self.cmd_perform_bac, mrz2, verbose=0)
+    
+    def session_lost(self):
+        ## The session keys are only valid for one connection, BAC is repeated by restore_session()
+        self.se = None
     
     def verify_cms(self, data):
         """Verify a pkcs7 SMIME message"""    
@@ -227,10 +250,10 @@ class Passport_Application(Application):
         s = SMIME.SMIME()
         
         # TODO: ugly hack for M2Crypto
-        body = TLV_utils.tlv_find_tag(TLV_utils.unpack(data), 0xA0,  1)[0][2]
-        thecert = TLV_utils.tlv_find_tag(body, 0xA0,  2)[1][2]
+        ## ContentInfo / [0] content / SignedData / [0] certificates
+        thecert = TLV_utils.lazy_unpack(data).get_index().query_first("30/A0/30/A0")
 
-        cert_bio = BIO.MemoryBuffer(TLV_utils.pack(thecert))
+        cert_bio = BIO.MemoryBuffer(thecert.value)
         
         # Load the signer's cert.
         x509 = X509.load_cert_bio(cert_bio,  format=0)
@@ -292,7 +315,7 @@ class Passport_Application(Application):
             i += 1
             result = self.open_file(fid, 0x0c)
             if self.check_sw(result.sw):
-                contents, sw = self.read_binary_file()
+                contents, sw = self.read_binary_file(tlv = True)
                 #self.last_result = R_APDU(contents + self.last_sw)
                 
                 if name != "SOD":
@@ -304,7 +327,7 @@ class Passport_Application(Application):
         #print "DG1: %s" % hexdump(hashes[i])
         #print "DG2: %s" % hexdump(hashes[2])
         
-        res = TLV_utils.tlv_find_tag(TLV_utils.unpack(result), 0x04)
+        res = TLV_utils.lazy_unpack(result).get_index().find(0x04)
         if len(res) == 0:
             print "failed to verify EF.SOD"
             return
@@ -312,7 +335,8 @@ class Passport_Application(Application):
             print "verified EF.SOD"
             
         i = 0
-        for tag, length, hash in res:
+        for node in res:
+            hash = node.value
             i += 1
             if hexdump(hashes[i]) == hexdump(hash):
                 print "DG%d hash verified: %s" % (i, binascii.b2a_hex(hash))
@@ -948,26 +972,30 @@ class Passport(object):
         p.result_map_select = {}
         p.result_map_read = {}
         
-        for name, fid in card.INTERESTING_FILES:
-            result = card.open_file(fid, 0x0C)
-            if not card.check_sw(result.sw) and not tried_bac and not mrz_data is _default_empty_mrz_data:
-                tried_bac = True
-                card.cmd_perform_bac(mrz_data[1], verbose=0)
+        card.begin_transaction()
+        try:
+            for name, fid in card.INTERESTING_FILES:
                 result = card.open_file(fid, 0x0C)
-            
-            p.result_map_select[fid] = result.sw
-            if card.check_sw(result.sw):
-                contents, sw = card.read_binary_file()
-                if not card.check_sw(sw) and not tried_bac and not mrz_data is _default_empty_mrz_data:
+                if not card.check_sw(result.sw) and not tried_bac and not mrz_data is _default_empty_mrz_data:
                     tried_bac = True
                     card.cmd_perform_bac(mrz_data[1], verbose=0)
-                    contents, sw = card.read_binary_file()
+                    result = card.open_file(fid, 0x0C)
                 
-                p.result_map_read[fid] = sw
-                if contents != "":
-                    setattr(p, "contents_%s" % name, contents)
-                    if hasattr(p, "parse_%s" % name):
-                        getattr(p, "parse_%s" % name)(contents)
+                p.result_map_select[fid] = result.sw
+                if card.check_sw(result.sw):
+                    contents, sw = card.read_binary_file(tlv = True)
+                    if not card.check_sw(sw) and not tried_bac and not mrz_data is _default_empty_mrz_data:
+                        tried_bac = True
+                        card.cmd_perform_bac(mrz_data[1], verbose=0)
+                        contents, sw = card.read_binary_file(tlv = True)
+                    
+                    p.result_map_read[fid] = sw
+                    if contents != "":
+                        setattr(p, "contents_%s" % name, contents)
+                        if hasattr(p, "parse_%s" % name):
+                            getattr(p, "parse_%s" % name)(contents)
+        finally:
+            card.end_transaction()
         
         return p
     from_card = classmethod(from_card)
@@ -1060,9 +1088,9 @@ class Passport(object):
     
     
     def parse_DG1(self, contents):
-        structure = TLV_utils.unpack(contents)
+        structure = TLV_utils.lazy_unpack(contents)
         try:
-            mrz = TLV_utils.tlv_find_tag(structure, 0x5F1F, 1)[0][2]
+            mrz = structure.find(0x5F1F, 1)[0].value
         except IndexError:
             raise PassportParseError, "Could not find MRZ information in DG1"
         # Length of an MRZ line is either 30+5 or 31+5 or 39+5, depending on document type. (LDS technical report 2004, section 16.1)
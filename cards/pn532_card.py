@@ -11,8 +11,15 @@ class PN532_Virtual_Card(Card):
 
     APDU_TRANSCEIVE_PN532 = C_APDU(cla=0xff, ins=0, p1=0, p2=0)
     
-    # The ACR122 has a maximum response data size of 0xf8
+    # The ACR122 has a maximum response data size of 0xf8, unless the reader
+    # object chains frames itself (see readers.ACR122_Reader.pn532_data_exchange)
     APDU_READ_BINARY = C_APDU(cla=0, ins=0xb0, le=0xf8)
+    APDU_READ_BINARY_CHAINED = C_APDU(cla=0, ins=0xb0, le=0)
+    
+    def __init__(self, reader):
+        Card.__init__(self, reader)
+        if getattr(reader, "SUPPORTS_CHAINING", False):
+            self.APDU_READ_BINARY = self.APDU_READ_BINARY_CHAINED
     
     def cmd_pn532(self, *cmd):
         "Transmit a command to the PN532 and receive the response"
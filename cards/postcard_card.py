@@ -18,7 +18,7 @@ class Postcard_Card(ISO_7816_4_Card):
     ]
 
     def _get_binary(self, offset, length):
-        command = C_APDU(self.APDU_READ_BINARY, p1 = offset >> 8, p2 = offset & 0xff, le = length)
+        command = self.APDU_READ_BINARY.with_params(p1 = offset >> 8, p2 = offset & 0xff, le = length)
         result = self.send_apdu(command)
         assert self.check_sw(result.sw)
         
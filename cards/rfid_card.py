@@ -50,6 +50,9 @@ class RFID_Storage_Card(building_blocks.Card_with_read_binary,RFID_Card):
     } )
     
     APDU_READ_BINARY = utils.C_APDU(CLA=0xff, INS=0xb0, Le=0)
+    APDU_UPDATE_BINARY = utils.C_APDU(CLA=0xff, INS=0xd6)
+    ## The PC/SC storage card commands are interpreted by the reader and have no extended form
+    EXTENDED_LENGTH = False
     COMMANDS = dict(building_blocks.Card_with_read_binary.COMMANDS)
     COMMANDS.update(RFID_Card.COMMANDS)
 
@@ -48,15 +48,15 @@ class VrsTicket(object):
     
     def _parse(self, contents):
         self._rawdata = contents
-        self._tlvdata = TLV_utils.unpack(contents)
+        self._tlvdata = TLV_utils.lazy_unpack(contents)
         
-        tmp = TLV_utils.tlv_find_tag(self._tlvdata, 0xEA, num_results = 1)
+        tmp = self._tlvdata.find(0xEA, num_results = 1)
         if len(tmp) == 0:
             raise ValueError, "Can't parse information file, tag 0xEA not found"
-        tmp = TLV_utils.tlv_find_tag(tmp, 0x85, num_results = 1)
+        tmp = tmp[0].find(0x85, num_results = 1)
         if len(tmp) == 0:
             raise ValueError, "Can't parse information file, tag 0x85 not found"
-        self._mainblob = tmp[0][2]
+        self._mainblob = tmp[0].value
         
         tmp = self._mainblob
         some_id, tmp = tmp[:4], tmp[4:]
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: iso-8859-1 -*-
 
-import crypto_utils, utils, cards, readers, os, re, binascii, sys, exceptions, traceback, getopt, datetime
+import crypto_utils, utils, cards, readers, trace_reader, apdu_script, os, re, binascii, sys, exceptions, traceback, getopt, datetime, time
 from shell import Shell
 
 class Logger(object):
@@ -49,7 +49,10 @@ class Cyberflex_Shell(Shell):
         self.set_prompt("(No card) ")
     
     def cmd_runscript(self, filename, ask = True):
-        "Run an APDU script from a file"
+        "Run an APDU script from a file (text, or compiled with compile_script)"
+        if apdu_script.is_compiled_script(filename):
+            return self._run_compiled_script(filename, ask)
+        
         fh = file(filename)
         
         doit = not ask
@@ -75,22 +78,57 @@ class Cyberflex_Shell(Shell):
                 else:
                     continue
             
+            line, expected, mask = apdu_script.split_expected_sw(line)
             self.parse_and_execute(line)
             
-            if self.card.sw_changed and not self.card.check_sw(self.card.last_sw) \
-                    and self.card.last_sw not in ignored_SWs:
-                
-                print "SW(%s) was not OK. Ignore (i) or Abort (a)? " % binascii.hexlify(self.card.last_sw),
-                answer = sys.stdin.readline()
-                if answer[0].lower() in ('i', "\n"):
-                    pass
-                elif answer[0].lower() == 'a':
+            if self.card.sw_changed and not apdu_script.check_sw(self.card, self.card.last_sw, expected, mask):
+                if not self._ask_sw_failed(self.card.last_sw, ignored_SWs):
                     return
-                elif answer[0] == 'S':
-                    ignored_SWs.append(self.card.last_sw)
-                    pass
-                else:
+    
+    def _ask_sw_failed(self, sw, ignored_SWs):
+        """Ask whether to continue a script after a SW that was not OK. Returns
+        False if the script should be aborted."""
+        if sw in ignored_SWs:
+            return True
+        
+        print "SW(%s) was not OK. Ignore (i) or Abort (a)? " % binascii.hexlify(sw),
+        answer = sys.stdin.readline()
+        if answer[0].lower() in ('i', "\n"):
+            return True
+        elif answer[0].lower() == 'a':
+            return False
+        elif answer[0] == 'S':
+            ignored_SWs.append(sw)
+            return True
+        else:
+            return False
+    
+    def _run_compiled_script(self, filename, ask = True):
+        script = apdu_script.Compiled_Script(filename)
+        try:
+            if ask:
+                print "Execute compiled script %s? (Yes/No) " % filename,
+                answer = sys.stdin.readline()
+                if answer[0].lower() not in ('y', "\n"):
                     return
+            
+            ignored_SWs = []
+            start = time.time()
+            executed, failed = apdu_script.run(self.card, script, self.parse_and_execute,
+                lambda sw: self._ask_sw_failed(sw, ignored_SWs))
+            print "%i records executed in %.3fs, %i SWs not OK" % (executed, time.time() - start, failed)
+        finally:
+            script.close()
+    
+    def cmd_compilescript(self, filename, outfilename):
+        "Compile an APDU script into the binary form for fast execution with run_script"
+        infile, outfile = file(filename), file(outfilename, "wb")
+        try:
+            count = apdu_script.compile_script(infile, outfile, self.get_command_mapping())
+        finally:
+            infile.close()
+            outfile.close()
+        print "%i records written to %s" % (count, outfilename)
     
     def cmd_listreaders(self):
         "List the available readers"
@@ -159,6 +197,14 @@ class Cyberflex_Shell(Shell):
         """Print the ATR of the currently inserted card."""
         print "ATR: %s" % utils.hexdump(self.card.reader.get_ATR(), short=True)
     
+    def cmd_stats(self, reset = None):
+        """Print the transport statistics of the current reader.
+        Give "reset" as argument to clear the counters after printing them."""
+        statistics = self.card.reader.get_statistics()
+        print statistics.format()
+        if reset == "reset":
+            statistics.reset()
+    
     def cmd_save_response(self, file_name, start = None, end = None):
         "Save the data in the last response to a file. start and end are optional"
         lastlen = len(self.card.last_result.data)
@@ -199,6 +245,7 @@ class Cyberflex_Shell(Shell):
     
     def cmd_disconnect(self, *args):
         "Close the connection to the currently inserted card"
+        self.stop_trace()
         self.unregister_post_hook(self._print_sw)
         self.fallback = None
         self.unregister_pre_hook(self._clear_sw)
@@ -210,7 +257,12 @@ class Cyberflex_Shell(Shell):
         self.set_prompt("(No card) ")
     
     def cmd_reconnect(self, reader = None):
-        "Re-open the connection to the card"
+        """Re-open the connection to the card. Without a reader the selected application,
+        authentication and file selection are restored. With a reader a new session is started."""
+        if reader is None:
+            if not self.card.reconnect():
+                print "Card did not come back, giving up"
+            return
         self.cmd_disconnect()
         self.cmd_connect(reader)
     
@@ -306,6 +358,24 @@ class Cyberflex_Shell(Shell):
         result = Shell.parse_and_execute(self, line)
         return result
     
+    def start_trace(self, filename):
+        self.stop_trace()
+        self.card.reader = trace_reader.Recording_Reader(self.card.reader, file(filename, "wb"))
+        print "Recording APDUs to %s" % filename
+    
+    def stop_trace(self):
+        if isinstance(self.card.reader, trace_reader.Recording_Reader):
+            self.card.reader.close()
+            self.card.reader = self.card.reader.parent
+            print "Trace stopped"
+    
+    def cmd_trace(self, filename = None):
+        "Start (when given a filename) or stop (otherwise) recording all APDUs to a binary trace file"
+        if filename is not None:
+            self.start_trace(filename)
+        else:
+            self.stop_trace()
+    
     def cmd_log(self, filename = None):
         "Start (when given a filename) or stop (otherwise) logging to a file"
         if filename is not None:
@@ -356,12 +426,27 @@ class Cyberflex_Shell(Shell):
         finally:
             self.register_commands(self.card)
     
-    def cmd_connect(self, reader = None):
-        "Open the connection to a card"
+    def cmd_connect(self, reader = None, timeout = None):
+        """Open the connection to a card. With reader "any", wait at most timeout 
+        seconds for a card to be inserted."""
         if reader is None:
             reader = self.reader
+        if timeout is not None:
+            timeout = float(timeout)
         
-        reader_object = readers.connect_to(reader)
+        reader_object = readers.connect_to(reader, timeout)
+        self._connect_card(reader_object)
+    
+    def cmd_replay(self, filename, strict = "strict"):
+        """Connect to a card simulated from a trace file (as written by the trace command).
+        strict may be given as "loose" to play back the responses even if the commands differ."""
+        reader_object = trace_reader.Replay_Reader(file(filename, "rb"), strict = (strict != "loose"))
+        print "Using reader: %s" % reader_object.name
+        if not reader_object.connect():
+            raise EOFError, "No card connect found in trace file"
+        self._connect_card(reader_object)
+    
+    def _connect_card(self, reader_object):
         self.card = cards.new_card_object(reader_object)
         
         self.unregister_commands(self, self.NOCARD_COMMANDS)
@@ -384,6 +469,7 @@ class Cyberflex_Shell(Shell):
         "fancy": cmd_fancy,
         "enc": cmd_enc,
         "log": cmd_log,
+        "compile_script": cmd_compilescript,
     } )
     
     CARD_COMMANDS = {
@@ -394,10 +480,13 @@ class Cyberflex_Shell(Shell):
         "driver_unload": cmd_unloaddriver,
         "raw": do_raw_apdu,
         "run_script": cmd_runscript,
+        "trace": cmd_trace,
+        "stats": cmd_stats,
     }
     
     NOCARD_COMMANDS = {
         "connect": cmd_connect,
+        "replay": cmd_replay,
     }
 
 def usage():
@@ -405,9 +494,12 @@ def usage():
 Synopsis: cyberflex-shell.py [options] [scriptfiles]
 Options:
     -r, --reader             Select the reader to use, either by
-                             index or by name
+                             index or by name, or "any" for the
+                             first reader that has a card in it
     -l, --list-readers       List the available readers and their
                              indices
+    -w, --wait               Seconds to wait for a card with
+                             --reader any (default: 30)
     -n, --dont-connect       Don't connect to the card on startup
     -y, --dont-ask           Don't ask for confirmation for every
                              command run from the scriptfiles
@@ -449,7 +541,7 @@ if __name__ == "__main__":
     shell = Cyberflex_Shell("cyberflex-shell")
     
     if not dont_connect:
-        shell.cmd_connect(helper.reader)
+        shell.cmd_connect(helper.reader, helper.timeout)
     
     shell.run_startup()
     
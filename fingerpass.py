@@ -40,7 +40,7 @@ def fingerprint_7816(card):
         
         if result.sw == "\x90\x00":
             prefix = str(SHORT_SW_MAP[result.sw])
-            result = card.send_apdu(utils.C_APDU(card.APDU_READ_BINARY, p1=0, p2=0, le=1))
+            result = card.send_apdu(card.APDU_READ_BINARY.with_params(p1=0, p2=0, le=1))
         else:
             prefix = ""
         
@@ -52,7 +52,7 @@ def fingerprint_7816(card):
     def map_dg(card):
         "Get a map of which DGs exist and are readable/unreadable and with which SW they are unreadable"
         # Try to read 1 byte from each DG through READ BINARY with short file identifier
-        responses = [card.send_apdu(utils.C_APDU(card.APDU_READ_BINARY, p1=i|0x80, p2=0, le=1)) for i in range(1,17)]
+        responses = [card.send_apdu(card.APDU_READ_BINARY.with_params(p1=i|0x80, p2=0, le=1)) for i in range(1,17)]
         
         result = []
         exceptional = []
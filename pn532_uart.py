@@ -0,0 +1,349 @@
+"""Direct access to a PN532 over its high speed UART (HSU).
+
+PN532_UART_Reader talks the PN532 frame protocol on a serial port, instead of
+wrapping every frame in an FF 00 00 pseudo APDU (and possibly an FF C0 GET
+RESPONSE) like the ACR122 does. All the ISO 14443-4 logic is inherited from
+readers.PN532_Reader, so the reader can be used everywhere a PC/SC reader is
+used, e.g. with connect_to("pn532:/dev/ttyUSB0").
+
+PN532_Emulator simulates a PN532 with a virtual_reader.Virtual_Card in its field
+on a pseudo terminal, for testing without hardware:
+    emulator = PN532_Emulator(virtual_reader.Virtual_Card())
+    emulator.start()
+    reader = PN532_UART_Reader(emulator.device)"""
+
+import os, select, termios, threading, time, readers, utils
+
+PREAMBLE = "\x00\x00\xff"
+ACK_FRAME = "\x00\x00\xff\x00\xff\x00"
+NACK_FRAME = "\x00\x00\xff\xff\x00\x00"
+
+## Sent before the first command to wake the PN532 from low VBAT mode on HSU
+WAKEUP = "\x55\x55" + "\x00" * 14
+
+FRAME_ACK = "ack"
+FRAME_NACK = "nack"
+FRAME_DATA = "data"
+FRAME_ERROR = "error"
+FRAME_INVALID = "invalid"
+
+def build_frame(data):
+    "Pack data (TFI and payload) into a normal or (above 255 bytes) extended information frame"
+    if len(data) < 0xff:
+        header = PREAMBLE + chr(len(data)) + chr(-len(data) & 0xff)
+    else:
+        length = chr(len(data) >> 8) + chr(len(data) & 0xff)
+        header = PREAMBLE + "\xff\xff" + length + chr(-(ord(length[0]) + ord(length[1])) & 0xff)
+    return header + data + chr(-sum(map(ord, data)) & 0xff) + "\x00"
+
+class Frame_Parser(object):
+    """Incremental parser for a stream of PN532 frames. feed() the bytes as they
+    arrive, next_frame() returns (type, data) tuples as soon as a frame is complete
+    (type is one of the FRAME_* constants, data is only set for FRAME_DATA) or None."""
+    
+    def __init__(self):
+        self.buffer = ""
+    
+    def feed(self, data):
+        self.buffer = self.buffer + data
+    
+    def next_frame(self):
+        start = self.buffer.find(PREAMBLE)
+        if start == -1:
+            ## Keep a possibly incomplete preamble at the end
+            self.buffer = self.buffer[-2:]
+            return None
+        buffer = self.buffer[start:]
+        if len(buffer) < 6:
+            return None
+        
+        if buffer[:6] == ACK_FRAME:
+            self.buffer = buffer[6:]
+            return (FRAME_ACK, None)
+        if buffer[:6] == NACK_FRAME:
+            self.buffer = buffer[6:]
+            return (FRAME_NACK, None)
+        
+        length, lcs = ord(buffer[3]), ord(buffer[4])
+        header = 5
+        if length == 0xff and lcs == 0xff:
+            if len(buffer) < 8:
+                return None
+            length = (ord(buffer[5]) << 8) | ord(buffer[6])
+            lcs = (ord(buffer[5]) + ord(buffer[6]) + ord(buffer[7])) & 0xff
+            header = 8
+        else:
+            lcs = (length + lcs) & 0xff
+        
+        if lcs != 0:
+            ## Not a frame after all, skip the preamble and resynchronize
+            self.buffer = buffer[3:]
+            return (FRAME_INVALID, None)
+        if len(buffer) < header + length + 2:
+            return None
+        
+        data = buffer[header:header+length]
+        dcs = ord(buffer[header+length])
+        self.buffer = buffer[header+length+2:]
+        
+        if (sum(map(ord, data)) + dcs) & 0xff != 0:
+            return (FRAME_INVALID, None)
+        if data == "\x7f":
+            return (FRAME_ERROR, None)
+        return (FRAME_DATA, data)
+
+class Serial_Port(object):
+    "Minimal raw serial port on POSIX systems, without depending on pyserial"
+    
+    BAUDRATES = {
+        9600: termios.B9600, 19200: termios.B19200, 38400: termios.B38400,
+        57600: termios.B57600, 115200: termios.B115200, 230400: termios.B230400,
+    }
+    
+    def __init__(self, device, baudrate = 115200):
+        if not self.BAUDRATES.has_key(baudrate):
+            raise ValueError, "baudrate must be one of %s" % ", ".join(map(str, sorted(self.BAUDRATES.keys())))
+        self.device = device
+        self.fd = os.open(device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            set_raw(self.fd, self.BAUDRATES[baudrate])
+        except:
+            os.close(self.fd)
+            raise
+    
+    def write(self, data):
+        while len(data) > 0:
+            select.select([], [self.fd], [])
+            written = os.write(self.fd, data)
+            data = data[written:]
+    
+    def read(self, timeout):
+        "Return whatever is available (at most 4096 bytes) within timeout seconds, or an empty string"
+        r, w, x = select.select([self.fd], [], [], max(timeout, 0))
+        if not r:
+            return ""
+        return os.read(self.fd, 4096)
+    
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def set_raw(fd, speed = None):
+    "Put a terminal into raw 8N1 mode, optionally setting the speed"
+    iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(fd)
+    iflag = 0
+    oflag = 0
+    cflag = termios.CS8 | termios.CREAD | termios.CLOCAL
+    lflag = 0
+    if speed is not None:
+        ispeed = ospeed = speed
+    cc = list(cc)
+    cc[termios.VMIN] = 0
+    cc[termios.VTIME] = 0
+    termios.tcsetattr(fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, ispeed, ospeed, cc])
+
+class PN532_UART_Reader(readers.PN532_Reader):
+    """A PN532 connected to a serial port (HSU). The command frame is written
+    in one go and the ACK and the response frame are parsed from the same input
+    stream, so a command costs one round trip on the line and no polling delay.
+    Corrupted responses are requested again with a NACK, commands that are not
+    acknowledged are repeated up to RETRIES times."""
+    
+    RETRIES = 3
+    ACK_TIMEOUT = 0.1
+    CONNECTION_ERRORS = (IOError, OSError)
+    
+    def __init__(self, device, baudrate = 115200, timeout = 1.0):
+        readers.PN532_Reader.__init__(self, "PN532 on %s" % device)
+        self.device = device
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self._port = None
+        self._parser = Frame_Parser()
+    
+    def list_readers(cls):
+        "Serial ports are not enumerated, instantiate explicitly or use connect_to(\"pn532:<device>\")"
+        return []
+    list_readers = classmethod(list_readers)
+    
+    def _open_transport(self):
+        if self._port is not None:
+            return
+        self._port = Serial_Port(self.device, self.baudrate)
+        self._parser = Frame_Parser()
+        self._port.write(WAKEUP)
+        ## SAMConfiguration: normal mode, no timeout, use IRQ
+        self.pn532_transceive("\xd4\x14\x01\x00\x01")
+    
+    def _read_frame(self, deadline):
+        while True:
+            frame = self._parser.next_frame()
+            if frame is not None:
+                return frame
+            data = self._port.read(deadline - time.time())
+            if data == "":
+                return None
+            self._parser.feed(data)
+    
+    def pn532_exchange(self, command):
+        if self._port is None:
+            raise IOError, "PN532 on %s is not connected" % self.device
+        frame = build_frame(command)
+        
+        for attempt in range(self.RETRIES):
+            self._port.write(frame)
+            
+            ## The write only fills the OS buffer, allow for the time on the line (10 bits per byte)
+            ack_deadline = time.time() + self.ACK_TIMEOUT + len(frame) * 10.0 / self.baudrate
+            ack = self._read_frame(ack_deadline)
+            while ack is not None and ack[0] == FRAME_INVALID:
+                ack = self._read_frame(ack_deadline)
+            if ack is None or ack[0] != FRAME_ACK:
+                self._parser = Frame_Parser()
+                continue
+            
+            deadline = time.time() + self.timeout
+            nacks = 0
+            while True:
+                response = self._read_frame(deadline)
+                if response is None:
+                    raise IOError, "PN532 did not respond within %gs" % self.timeout
+                if response[0] == FRAME_DATA:
+                    return response[1]
+                if response[0] == FRAME_ERROR:
+                    raise IOError, "PN532 reported a syntax error in the command frame"
+                if response[0] == FRAME_INVALID and nacks < self.RETRIES:
+                    ## Ask for the response to be sent again
+                    nacks = nacks + 1
+                    self._port.write(NACK_FRAME)
+        
+        raise IOError, "PN532 did not acknowledge the command"
+    
+    def disconnect(self):
+        if self._port is not None:
+            try:
+                ## RF field off, so that the next connect starts with a fresh card
+                self.pn532_transceive("\xd4\x32\x01\x00")
+            finally:
+                self._port.close()
+                self._port = None
+        self._current_target = None
+
+class PN532_Emulator(threading.Thread):
+    """Simulates a PN532 on the master side of a pseudo terminal, device is the
+    name of the slave side to be used with PN532_UART_Reader. The field contains
+    card (a virtual_reader.Virtual_Card, or None for an empty field), which answers
+    as an ISO 14443-4 type A card with the given NFCID."""
+    
+    MAX_FRAME_DATA = 0xfc
+    
+    def __init__(self, card = None, nfcid = "\x08\x12\x34\x56", ats = "\x05\x78\x80\x70\x02"):
+        threading.Thread.__init__(self, name = "PN532_Emulator")
+        self.setDaemon(True)
+        self.card = card
+        self.nfcid = nfcid
+        self.ats = ats
+        self.frames_received = 0
+        self._master, self._slave = os.openpty()
+        set_raw(self._master)
+        set_raw(self._slave)
+        self.device = os.ttyname(self._slave)
+        self._stop = False
+        self._command = ""
+        self._response = ""
+        self._last_response = None
+    
+    def stop(self):
+        self._stop = True
+        self.join()
+        os.close(self._master)
+        os.close(self._slave)
+    
+    def run(self):
+        parser = Frame_Parser()
+        while not self._stop:
+            r, w, x = select.select([self._master], [], [], 0.05)
+            if not r:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                continue
+            parser.feed(data)
+            while True:
+                frame = parser.next_frame()
+                if frame is None:
+                    break
+                if frame[0] == FRAME_NACK and self._last_response is not None:
+                    os.write(self._master, self._last_response)
+                elif frame[0] == FRAME_DATA:
+                    self.frames_received = self.frames_received + 1
+                    os.write(self._master, ACK_FRAME)
+                    self._last_response = build_frame(self.process(frame[1]))
+                    os.write(self._master, self._last_response)
+    
+    def process(self, frame):
+        "Process one command frame, return the response frame"
+        if len(frame) < 2 or frame[0] != "\xd4":
+            return "\x7f"
+        command, data = ord(frame[1]), frame[2:]
+        response = "\xd5" + chr(command + 1)
+        
+        if command == 0x02:   # GetFirmwareVersion
+            return response + "\x32\x01\x06\x07"
+        elif command in (0x14, 0x32):   # SAMConfiguration, RFConfiguration
+            if command == 0x32 and data[:2] == "\x01\x00":
+                self._command = self._response = ""
+            return response
+        elif command == 0x4a:   # InListPassiveTarget
+            if self.card is None or data[1:2] != "\x00":
+                return response + "\x00"
+            self.card.reset()
+            return response + "\x01" + self._target_data()
+        elif command == 0x60:   # InAutoPoll
+            if self.card is None:
+                return response + "\x00"
+            self.card.reset()
+            target_data = self._target_data()
+            return response + "\x01\x20" + chr(len(target_data)) + target_data
+        elif command == 0x40:   # InDataExchange
+            return response + self._data_exchange(ord(data[0]), data[1:])
+        return "\x7f"
+    
+    def _target_data(self):
+        return "\x01\x00\x04\x20" + chr(len(self.nfcid)) + self.nfcid + self.ats
+    
+    def _data_exchange(self, target, data):
+        if self.card is None:
+            return "\x01"  # Timeout
+        
+        if len(self._response) == 0:
+            self._command = self._command + data
+            if target & 0x40:
+                return "\x00"
+            self._response = self.card.process(self._command)
+            self._command = ""
+        
+        chunk, self._response = self._response[:self.MAX_FRAME_DATA], self._response[self.MAX_FRAME_DATA:]
+        if len(self._response) > 0:
+            return "\x40" + chunk
+        return "\x00" + chunk
+
+if __name__ == "__main__":
+    import virtual_reader
+    card = virtual_reader.Virtual_Card()
+    card.add_ef("\x3f\x00", "\x01\x01", data = "".join([chr(i % 256) for i in range(1000)]))
+    
+    emulator = PN532_Emulator(card)
+    emulator.start()
+    
+    reader = PN532_UART_Reader(emulator.device)
+    reader.connect()
+    print "Connected to %s, ATR %s" % (reader.name, utils.hexdump(reader.get_ATR(), short = True))
+    start = time.time()
+    for c_apdu in ("\x00\xa4\x02\x0c\x02\x01\x01", "\x00\xb0\x00\x00\x00", "\x00\xb0\x00\x00\x00\x03\xe8"):
+        print utils.hexdump(c_apdu, short = True), "->", utils.hexdump(reader.transceive(c_apdu)[-2:], short = True)
+    print "%i frames in %0.3fs" % (emulator.frames_received, time.time() - start)
+    reader.disconnect()
+    emulator.stop()
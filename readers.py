@@ -8,9 +8,236 @@ pycsc you'll need to downgrade to SVN revision 246.
 """
     raise
 
-import sys, utils, getopt, binascii, time
+import sys, utils, getopt, binascii, time, threading, Queue, bisect
+
+class Async_Result(object):
+    """The pending result of a call submitted to a Reader_Executor. Modelled after
+    concurrent.futures.Future: result() blocks until the call has finished and 
+    returns its value or re-raises its exception, callbacks registered with 
+    add_done_callback() are called with this object from the executor thread
+    (use e.g. loop.call_soon_threadsafe in them to hand over to an event loop)."""
+    
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+    
+    def done(self):
+        return self._event.isSet()
+    
+    def result(self, timeout = None):
+        self._event.wait(timeout)
+        if not self._event.isSet():
+            raise RuntimeError, "Timeout while waiting for the result"
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+    
+    def exception(self, timeout = None):
+        self._event.wait(timeout)
+        if not self._event.isSet():
+            raise RuntimeError, "Timeout while waiting for the result"
+        return self._exc_info and self._exc_info[1] or None
+    
+    def add_done_callback(self, function):
+        self._lock.acquire()
+        try:
+            if not self._event.isSet():
+                self._callbacks.append(function)
+                return
+        finally:
+            self._lock.release()
+        function(self)
+    
+    def _set(self, result, exc_info):
+        self._lock.acquire()
+        try:
+            self._result = result
+            self._exc_info = exc_info
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for function in callbacks:
+            function(self)
+
+class Reader_Executor(threading.Thread):
+    """A dedicated thread that executes calls for exactly one reader, in
+    the order they were submitted. Use Smartcard_Reader.get_executor() 
+    instead of instantiating this directly."""
+    
+    _STOP = object()
+    
+    def __init__(self, name):
+        threading.Thread.__init__(self, name = "Reader_Executor(%s)" % name)
+        self.setDaemon(True)
+        self._calls = Queue.Queue()
+        self.start()
+    
+    def submit(self, function, *args, **kwargs):
+        "Schedule function(*args, **kwargs) and return an Async_Result for it"
+        pending = Async_Result()
+        self._calls.put( (pending, function, args, kwargs) )
+        return pending
+    
+    def run(self):
+        while True:
+            item = self._calls.get()
+            if item is self._STOP:
+                break
+            
+            pending, function, args, kwargs = item
+            try:
+                result = function(*args, **kwargs)
+            except:
+                pending._set(None, sys.exc_info())
+            else:
+                pending._set(result, None)
+    
+    def shutdown(self, wait = True):
+        self._calls.put(self._STOP)
+        if wait and threading.currentThread() is not self:
+            self.join()
+
+class Latency_Histogram(object):
+    "Counts durations (in seconds) into the buckets given by BUCKETS (upper bounds)"
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+    
+    def add(self, duration):
+        self.counts[bisect.bisect_left(self.BUCKETS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if self.min is None or duration < self.min: self.min = duration
+        if self.max is None or duration > self.max: self.max = duration
+    
+    def get_mean(self):
+        return self.count and self.total / self.count or 0.0
+    
+    def format(self):
+        "Return a one line summary: count, min/mean/max and the non-empty buckets"
+        buckets = []
+        for index, count in enumerate(self.counts):
+            if count == 0: continue
+            if index < len(self.BUCKETS):
+                buckets.append("<%gms:%i" % (self.BUCKETS[index]*1000, count))
+            else:
+                buckets.append(">%gms:%i" % (self.BUCKETS[-1]*1000, count))
+        return "%6i  %8.2f %8.2f %8.2f  %s" % (self.count, (self.min or 0)*1000, self.get_mean()*1000, 
+            (self.max or 0)*1000, " ".join(buckets))
+
+class Transport_Statistics(object):
+    """Counters about the traffic through one reader: number of APDUs, bytes in 
+    each direction, latency histograms by CLA/INS and by status word, and counts
+    of named events (such as "get_response" or "retry", counted by the card layer).
+    APDUs are recorded by the readers' transceive(). Readers that talk to the card
+    through a chip of their own (PN532) also record every frame that they exchange
+    with the chip, including chaining, polling and target selection."""
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.apdus = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.busy_time = 0.0
+        self.start_time = time.time()
+        self.by_command = {}
+        self.by_sw = {}
+        self.events = {}
+        self.frames = 0
+        self.frame_bytes_out = 0
+        self.frame_bytes_in = 0
+        self.by_frame = {}
+    
+    def record(self, command, response, duration):
+        "Record the exchange of the binary strings command and response that took duration seconds"
+        self.apdus += 1
+        self.bytes_out += len(command)
+        self.bytes_in += len(response)
+        self.busy_time += duration
+        
+        key = command[:2]
+        h = self.by_command.get(key)
+        if h is None:
+            h = self.by_command[key] = Latency_Histogram()
+        h.add(duration)
+        
+        key = response[-2:]
+        h = self.by_sw.get(key)
+        if h is None:
+            h = self.by_sw[key] = Latency_Histogram()
+        h.add(duration)
+    
+    def record_frame(self, command, response, duration):
+        "Record the exchange of a reader specific frame (e.g. a PN532 command) that took duration seconds"
+        self.frames += 1
+        self.frame_bytes_out += len(command)
+        self.frame_bytes_in += len(response)
+        
+        key = command[:2]
+        h = self.by_frame.get(key)
+        if h is None:
+            h = self.by_frame[key] = Latency_Histogram()
+        h.add(duration)
+    
+    def count(self, event):
+        self.events[event] = self.events.get(event, 0) + 1
+    
+    def get_stats(self):
+        "Return the current counters as a dictionary"
+        elapsed = time.time() - self.start_time
+        return {
+            "apdus": self.apdus,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+            "busy_time": self.busy_time,
+            "elapsed": elapsed,
+            "apdus_per_second": elapsed > 0 and self.apdus / elapsed or 0.0,
+            "events": dict(self.events),
+            "by_command": dict(self.by_command),
+            "by_sw": dict(self.by_sw),
+            "frames": self.frames,
+            "frame_bytes_out": self.frame_bytes_out,
+            "frame_bytes_in": self.frame_bytes_in,
+            "by_frame": dict(self.by_frame),
+        }
+    
+    def format(self):
+        "Return a human readable multi-line report"
+        stats = self.get_stats()
+        result = ["%(apdus)i APDUs, %(bytes_out)i bytes out, %(bytes_in)i bytes in, %(busy_time)0.3fs in transceive, %(apdus_per_second)0.1f APDUs/s" % stats]
+        if self.frames > 0:
+            result.append("%(frames)i reader frames, %(frame_bytes_out)i bytes out, %(frame_bytes_in)i bytes in" % stats)
+        if len(self.events) > 0:
+            result.append( ", ".join( ["%s: %i" % e for e in sorted(self.events.items())] ) )
+        
+        header = "%-8s %6s  %8s %8s %8s  %s" % ("", "count", "min ms", "mean ms", "max ms", "histogram")
+        for title, histograms in (("CLA INS", self.by_command), ("SW", self.by_sw), ("FRAME", self.by_frame)):
+            if len(histograms) == 0:
+                continue
+            result.append("")
+            result.append(header.replace(" "*len(title), title, 1))
+            for key, h in sorted(histograms.items()):
+                result.append("%-8s %s" % (binascii.b2a_hex(key).upper(), h.format()))
+        return "\n".join(result)
+
+class TransactionTimeoutError(Exception):
+    pass
 
 class Smartcard_Reader(object):
+    ## Exceptions raised by transceive() when the connection to the card has been lost
+    CONNECTION_ERRORS = (smartcard.Exceptions.CardConnectionException, )
+    
     def list_readers(cls):
         "Return a list of tuples: (reader name, implementing object)"
         return []
@@ -42,6 +269,77 @@ class Smartcard_Reader(object):
                     printed = True
         return have_card
     
+    _transaction_depth = 0
+    def begin_transaction(self, timeout = None):
+        """Start an exclusive transaction: until the matching end_transaction() no other
+        thread of this process and (for PC/SC readers) no other application can talk to
+        the card. Transactions nest, only the outermost pair locks and unlocks the card.
+        timeout limits the wait (in seconds) for another thread of this process to end
+        its transaction, TransactionTimeoutError is raised when it expires. Note that
+        the wait for another PC/SC client is not limited, pcscd has no means for that."""
+        lock = self.__dict__.setdefault("_transaction_lock", threading.RLock())
+        if timeout is None:
+            lock.acquire()
+        else:
+            deadline = time.time() + timeout
+            while not lock.acquire(False):
+                if time.time() >= deadline:
+                    raise TransactionTimeoutError, "Reader %s is locked by another thread" % self.name
+                time.sleep(0.005)
+        
+        if self._transaction_depth == 0:
+            try:
+                self._begin_transaction()
+            except:
+                lock.release()
+                raise
+        self._transaction_depth = self._transaction_depth + 1
+    
+    def end_transaction(self):
+        "End the transaction started by the matching begin_transaction()"
+        lock = self.__dict__.get("_transaction_lock")
+        if lock is None or self._transaction_depth == 0:
+            raise ValueError, "end_transaction() without begin_transaction()"
+        self._transaction_depth = self._transaction_depth - 1
+        try:
+            if self._transaction_depth == 0:
+                self._end_transaction()
+        finally:
+            lock.release()
+    
+    def _begin_transaction(self):
+        "Lock the card for exclusive access, called for the outermost transaction only"
+        pass
+    
+    def _end_transaction(self):
+        pass
+    
+    def _restore_transaction(self):
+        """Lock the card again after a reconnect inside a transaction. Only the lock on 
+        the card is renewed, the nesting depth and the thread lock are unchanged."""
+        self._begin_transaction()
+    
+    def reconnect(self, timeout = 5.0):
+        """Drop the current connection (if any is left) and connect to the card again,
+        waiting at most timeout seconds for it to come back. Returns True on success."""
+        try:
+            self.disconnect()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            pass
+        
+        deadline = time.time() + timeout
+        for result in self._internal_connect():
+            if result is self._CONNECT_DONE:
+                if self._transaction_depth > 0:
+                    ## The lock on the card was lost with the old connection
+                    self._restore_transaction()
+                return True
+            if time.time() >= deadline:
+                break
+        return False
+    
     def get_ATR(self):
         "Get the ATR of the inserted card as a binary string"
         raise NotImplementedError, "Please implement in a sub-class"
@@ -53,12 +351,38 @@ class Smartcard_Reader(object):
     def disconnect(self):
         "Disconnect from the card and release all resources"
         raise NotImplementedError, "Please implement in a sub-class"
+    
+    _statistics = None
+    def get_statistics(self):
+        "Return the Transport_Statistics object of this reader"
+        if self._statistics is None:
+            self._statistics = Transport_Statistics()
+        return self._statistics
+    
+    _executor = None
+    def get_executor(self):
+        "Return the Reader_Executor dedicated to this reader, starting it if necessary"
+        if self._executor is None:
+            self._executor = Reader_Executor(getattr(self, "name", repr(self)))
+        return self._executor
+    
+    def shutdown_executor(self, wait = True):
+        "Stop the dedicated executor, if any. Calls already submitted will still be executed."
+        if self._executor is not None:
+            self._executor.shutdown(wait)
+            self._executor = None
+    
+    def transceive_async(self, data):
+        """Like transceive(), but executed on this reader's executor thread. 
+        Returns an Async_Result for the response."""
+        return self.get_executor().submit(self.transceive, data)
 
 class PCSC_Reader(Smartcard_Reader):
     def __init__(self, reader):
         self._reader = reader
         self._name = str(reader)
         self._cardservice = None
+        self._protocol = None
     
     name = property(lambda self: self._name, None, None, "The human readable name of the reader")
     
@@ -80,6 +404,7 @@ class PCSC_Reader(Smartcard_Reader):
                 
                 self._cardservice = cardrequest.waitforcard()
                 self._cardservice.connection.connect()
+                self._protocol = None
                 del cardrequest
                 yield self._CONNECT_DONE
             except TypeError:
@@ -102,8 +427,11 @@ class PCSC_Reader(Smartcard_Reader):
         return smartcard.util.toASCIIString(self._cardservice.connection.getATR())
     
     def get_protocol(self):
-        hresult, reader, state, protocol, atr = smartcard.scard.SCardStatus( self._cardservice.connection.component.hcard )
-        return ((protocol == smartcard.scard.SCARD_PROTOCOL_T0) and (0,) or (1,))[0]
+        "Return the negotiated protocol (0 or 1), cached for the lifetime of the connection"
+        if self._protocol is None:
+            hresult, reader, state, protocol, atr = smartcard.scard.SCardStatus( self._cardservice.connection.component.hcard )
+            self._protocol = ((protocol == smartcard.scard.SCARD_PROTOCOL_T0) and (0,) or (1,))[0]
+        return self._protocol
 
     PROTOMAP = {
         0: smartcard.scard.SCARD_PCI_T0,
@@ -111,57 +439,121 @@ class PCSC_Reader(Smartcard_Reader):
     }
     
     def transceive(self, data):
-        data_bytes = map(lambda x: ord(x), data)
-        data, sw1, sw2 = self._cardservice.connection.transmit(data_bytes, protocol=self.PROTOMAP[self.get_protocol()])
-        result_binary = map(lambda x: chr(x), data + [sw1,sw2])
-        return result_binary
+        """Send a binary string, receive a binary string.
+        Talks to SCardTransmit directly, the response (data + SW) is returned as 
+        one str object without going through per-byte lists."""
+        start = time.time()
+        hresult, response = smartcard.scard.SCardTransmit( self._cardservice.connection.component.hcard,
+            self.PROTOMAP[self.get_protocol()], list(bytearray(data)) )
+        if hresult != smartcard.scard.SCARD_S_SUCCESS:
+            raise smartcard.Exceptions.CardConnectionException, "Failed to transmit with protocol T%i: %s" % (
+                self.get_protocol(), smartcard.scard.SCardGetErrorMessage(hresult) )
+        response = str(bytearray(response))
+        self.get_statistics().record(data, response, time.time() - start)
+        return response
+    
+    def _begin_transaction(self):
+        hresult = smartcard.scard.SCardBeginTransaction( self._cardservice.connection.component.hcard )
+        if hresult != smartcard.scard.SCARD_S_SUCCESS:
+            raise smartcard.Exceptions.CardConnectionException, "Failed to begin transaction: %s" % (
+                smartcard.scard.SCardGetErrorMessage(hresult) )
+    
+    def _end_transaction(self):
+        ## The result is ignored: If the card was reset or removed in the meantime the
+        ##  transaction is over anyway
+        if self._cardservice is not None:
+            smartcard.scard.SCardEndTransaction( self._cardservice.connection.component.hcard, 
+                smartcard.scard.SCARD_LEAVE_CARD )
     
     def disconnect(self):
         self._cardservice.connection.disconnect()
         del self._cardservice
         self._cardservice = None
+        self._protocol = None
     
-class ACR122_Reader(Smartcard_Reader):
-    """This class implements ISO 14443-4 access through the
-    PN532 in an ACR122 reader with firmware version 1.x"""
-    def list_readers(cls):
-        pcsc_readers = PCSC_Reader.list_readers()
-        readers = []
-        for name, obj in pcsc_readers:
-            if name.startswith("ACS ACR 38U-CCID"):
-                reader = cls(obj)
-                readers.append( (reader.name, reader) )
-        return readers
-    list_readers = classmethod(list_readers)
+class PN532_Reader(Smartcard_Reader):
+    """This class implements ISO 14443-4 access through a PN532. Sub-classes
+    implement the transport to the chip: pn532_exchange() sends one command frame 
+    (starting with D4) and returns the response frame (starting with D5), 
+    _open_transport() is called at the start of each connect."""
     
     name = property(lambda self: self._name, None, None, "The human readable name of the reader")
     
-    def __init__(self, parent):
-        self._parent = parent
-        self._name = self._parent.name+"-RFID"
+    ## A lost target shows up as an IOError from pn532_data_exchange()
+    CONNECTION_ERRORS = (smartcard.Exceptions.CardConnectionException, IOError)
+    
+    ## Maximum number of bytes of target data in one InDataExchange frame, larger
+    ## commands and responses are chained through the MI bit
+    MAX_FRAME_DATA = 0xfc
+    PN532_MI = 0x40
+    PN532_STATUS_ERROR_MASK = 0x3f
+    SUPPORTS_CHAINING = True
+    
+    ACQUIRE_MODE_LIST = "list"          # RF reset, then InListPassiveTarget for type A and type B
+    ACQUIRE_MODE_AUTOPOLL = "autopoll"  # InAutoPoll, no RF reset
+    
+    ## InAutoPoll target types: Passive 106 kbps ISO/IEC14443-4A and ISO/IEC14443-4B
+    AUTOPOLL_TYPES = (0x20, 0x23)
+    
+    def __init__(self, name):
+        self._name = name
         self._current_target = None
         self._current_target_number = 0
-    
-    def pn532_transceive_raw(self, command):
-        c_apdu = "\xff\x00\x00" + chr((len(command) >> 8)) + chr(len(command) % 256) + command
-        r_apdu = self._parent.transceive(c_apdu)
         
-        if len(r_apdu) == 2 and r_apdu[0] == "\x61":
-            c_apdu = "\xff\xc0\x00\x00" + r_apdu[1]
-            r_apdu = self._parent.transceive(c_apdu)
-        
-        return r_apdu
+        self.acquire_mode = self.ACQUIRE_MODE_LIST
+        self.autopoll_count = 1
+        self.autopoll_period = 1
+        self.autopoll_types = self.AUTOPOLL_TYPES
+        ## Running aggregates only, a long running process detects any number of cards
+        self.detection_latencies = Latency_Histogram()
+        self.last_detection_latency = None
+    
+    def set_acquire_mode(self, mode, period = None, count = None, types = None):
+        """Select how _internal_connect() looks for cards. mode is one of ACQUIRE_MODE_LIST
+        or ACQUIRE_MODE_AUTOPOLL. For ACQUIRE_MODE_AUTOPOLL, period is the time between
+        two polls in units of 150ms (1 to 15), count the number of polls per InAutoPoll
+        command (1 to 254, 255 means endless) and types a sequence of InAutoPoll
+        target type bytes."""
+        if mode not in (self.ACQUIRE_MODE_LIST, self.ACQUIRE_MODE_AUTOPOLL):
+            raise ValueError, "mode must be one of ACQUIRE_MODE_LIST or ACQUIRE_MODE_AUTOPOLL"
+        if period is not None:
+            if not 1 <= period <= 15:
+                raise ValueError, "period must be between 1 and 15 (inclusive)"
+            self.autopoll_period = period
+        if count is not None:
+            if not 1 <= count <= 255:
+                raise ValueError, "count must be between 1 and 255 (inclusive)"
+            self.autopoll_count = count
+        if types is not None:
+            if not 1 <= len(types) <= 15:
+                raise ValueError, "need between 1 and 15 target types"
+            self.autopoll_types = tuple(types)
+        self.acquire_mode = mode
+    
+    def get_detection_stats(self):
+        """Return a dictionary with statistics (in seconds) about the time between the start
+        of a connect() and the detection of a card"""
+        h = self.detection_latencies
+        if h.count == 0:
+            return {"count": 0, "min": None, "max": None, "mean": None, "last": None}
+        return {"count": h.count, "min": h.min, "max": h.max, "mean": h.get_mean(), "last": self.last_detection_latency}
+    
+    def pn532_exchange(self, command):
+        "Send one command frame to the PN532 and return its response frame"
+        raise NotImplementedError, "Please implement in a sub-class"
+    
+    def _open_transport(self):
+        raise NotImplementedError, "Please implement in a sub-class"
     
     def pn532_transceive(self, command):
-        response = self.pn532_transceive_raw(command)
+        start = time.time()
+        response = self.pn532_exchange(command)
+        self.get_statistics().record_frame(command, response, time.time() - start)
         
-        if len(response) < 2 or response[-2:] != ["\x90", "\x00"]:
-            raise IOError, "Couldn't communicate with PN532"
-        
-        if not (response[0] == "\xd5" and ord(response[1]) == ord(command[1])+1 ): 
+        if not (len(response) >= 2 and response[0] == "\xd5" and ord(response[1]) == ord(command[1])+1 ): 
             raise IOError, "Wrong response from PN532"
         
-        return "".join(response[:-2])
+        return response
     
     def pn532_acquire_card(self):
         # Turn antenna power off and on to forcefully reinitialize the card
@@ -184,15 +576,39 @@ class ACR122_Reader(Smartcard_Reader):
                 self._current_target_number, self._current_target = r.targets.items()[0]
                 return True
     
+    def pn532_autopoll_card(self):
+        "Poll for a card with InAutoPoll, without resetting the RF field"
+        self._last_ats = []
+        
+        command = "\xd4\x60" + chr(self.autopoll_count) + chr(self.autopoll_period) \
+            + "".join(map(chr, self.autopoll_types))
+        response = self.pn532_transceive(command)
+        r = utils.PN532_Frame(response)
+        r.parse_result()
+        if len(r.targets) > 0:
+            self._current_target_number, self._current_target = r.targets.items()[0]
+            return True
+        return False
+    
     def _internal_connect(self):
-        self._parent.connect()
+        self._open_transport()
         self.pn532_transceive("\xd4\x32\x05\x00\x00\x00")
+        start = time.time()
         while True:
-            if self.pn532_acquire_card():
+            if self.acquire_mode == self.ACQUIRE_MODE_AUTOPOLL:
+                found = self.pn532_autopoll_card()
+            else:
+                found = self.pn532_acquire_card()
+            
+            if found:
+                self.last_detection_latency = time.time() - start
+                self.detection_latencies.add(self.last_detection_latency)
                 yield self._CONNECT_DONE
             else:
                 yield self._CONNECT_NO_CARD
-                time.sleep(1)
+                if self.acquire_mode != self.ACQUIRE_MODE_AUTOPOLL:
+                    ## InAutoPoll already waits for the poll period inside the PN532
+                    time.sleep(1)
     
     @staticmethod
     def _extract_historical_bytes_from_ats(ats):
@@ -235,6 +651,12 @@ class ACR122_Reader(Smartcard_Reader):
 
 
     def transceive(self, data):
+        start = time.time()
+        response = self._transceive(data)
+        self.get_statistics().record(data, response, time.time() - start)
+        return response
+    
+    def _transceive(self, data):
         try:
             command = utils.C_APDU(data)
             result = []
@@ -283,37 +705,302 @@ class ACR122_Reader(Smartcard_Reader):
             # Just go on and try to process the data normally
             pass
         
-        response = self.pn532_transceive("\xd4\x40" + chr(self._current_target_number) + data)
-        if response[2] != "\x00":
-            # FIXME Proper error processing
-            raise IOError, "Error while transceiving"
-        return response[3:]
+        return self.pn532_data_exchange(data)
+    
+    def pn532_data_exchange(self, data):
+        """Exchange data with the current target through InDataExchange. Command and response
+        are split into frames of at most MAX_FRAME_DATA bytes and chained with the MI bit, 
+        so that data of any length (e.g. extended length APDUs) can be transferred."""
+        target = self._current_target_number
+        
+        pos = 0
+        while len(data) - pos > self.MAX_FRAME_DATA:
+            response = self.pn532_transceive("\xd4\x40" + chr(target | self.PN532_MI) + data[pos:pos+self.MAX_FRAME_DATA])
+            if ord(response[2]) & self.PN532_STATUS_ERROR_MASK != 0:
+                raise IOError, "Error while transceiving (status 0x%02X)" % ord(response[2])
+            pos = pos + self.MAX_FRAME_DATA
+        
+        response = self.pn532_transceive("\xd4\x40" + chr(target) + data[pos:])
+        result = [response[3:]]
+        while True:
+            status = ord(response[2])
+            if status & self.PN532_STATUS_ERROR_MASK != 0:
+                # FIXME Proper error processing
+                raise IOError, "Error while transceiving (status 0x%02X)" % status
+            if not status & self.PN532_MI:
+                break
+            response = self.pn532_transceive("\xd4\x40" + chr(target))
+            result.append(response[3:])
+        
+        return "".join(result)
 
+class ACR122_Reader(PN532_Reader):
+    """This class implements ISO 14443-4 access through the
+    PN532 in an ACR122 reader with firmware version 1.x"""
+    PCSC_NAME_PREFIX = "ACS ACR 38U-CCID"
+    
+    ## The ACR122 firmware limits the size of the PN532 frames in its pseudo APDUs
+    MAX_FRAME_DATA = 0xf0
+    
+    def list_readers(cls):
+        pcsc_readers = PCSC_Reader.list_readers()
+        readers = []
+        for name, obj in pcsc_readers:
+            if cls.can_wrap(obj):
+                reader = cls(obj)
+                readers.append( (reader.name, reader) )
+        return readers
+    list_readers = classmethod(list_readers)
+    
+    def can_wrap(cls, pcsc_reader):
+        "Determine whether a PCSC_Reader object is an ACR122 that this class can drive"
+        return pcsc_reader.name.startswith(cls.PCSC_NAME_PREFIX)
+    can_wrap = classmethod(can_wrap)
+    
+    def __init__(self, parent):
+        PN532_Reader.__init__(self, parent.name+"-RFID")
+        self._parent = parent
+    
+    def pn532_transceive_raw(self, command):
+        c_apdu = "\xff\x00\x00" + chr((len(command) >> 8)) + chr(len(command) % 256) + command
+        r_apdu = self._parent.transceive(c_apdu)
+        
+        if len(r_apdu) == 2 and r_apdu[0] == "\x61":
+            c_apdu = "\xff\xc0\x00\x00" + r_apdu[1]
+            r_apdu = self._parent.transceive(c_apdu)
+        
+        return r_apdu
+    
+    def pn532_exchange(self, command):
+        response = self.pn532_transceive_raw(command)
+        
+        if len(response) < 2 or response[-2:] != "\x90\x00":
+            raise IOError, "Couldn't communicate with PN532"
+        
+        return response[:-2]
+    
+    def _open_transport(self):
+        self._parent.connect()
+    
+    def _begin_transaction(self):
+        self._parent.begin_transaction()
+    
+    def _end_transaction(self):
+        self._parent.end_transaction()
+    
+    def _restore_transaction(self):
+        ## The parent is still inside the transaction begun by _begin_transaction(),
+        ##  only its new card handle must be locked
+        self._parent._restore_transaction()
+    
     def disconnect(self):
         self._parent.disconnect()
 
+class Reader_Registry(object):
+    """Process-wide cache of the available readers. The readers are enumerated 
+    once, after that the list is kept up to date incrementally by a pyscard 
+    ReaderMonitor (if available), so that the reader objects are created only once 
+    and lookups by index or name don't need a new PC/SC context."""
+    
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._pcsc_readers = None # List of (name, PCSC_Reader, [wrapping (name, object) tuples])
+        self._readers = []
+        self._by_name = {}
+        self._monitor = None
+    
+    def _wrap(self, pcsc_reader):
+        "Create the driver objects for a pyscard reader"
+        obj = PCSC_Reader(pcsc_reader)
+        wrappers = []
+        if ACR122_Reader.can_wrap(obj):
+            wrapper = ACR122_Reader(obj)
+            wrappers.append( (wrapper.name, wrapper) )
+        return (obj.name, obj, wrappers)
+    
+    def _rebuild(self):
+        "Recalculate the index structures. Order is the same as with a fresh enumeration."
+        readers = [ (name, obj) for name, obj, wrappers in self._pcsc_readers ]
+        for name, obj, wrappers in self._pcsc_readers:
+            readers.extend(wrappers)
+        self._readers = readers
+        self._by_name = dict(readers)
+    
+    def _enumerate(self):
+        try:
+            pcsc_readers = smartcard.System.readers()
+        except smartcard.pcsc.PCSCExceptions.EstablishContextException:
+            pcsc_readers = []
+        self._pcsc_readers = [ self._wrap(r) for r in pcsc_readers ]
+        self._rebuild()
+        self.start_monitoring()
+    
+    def refresh(self):
+        "Throw away all cached information and enumerate again"
+        self._lock.acquire()
+        try:
+            self._enumerate()
+        finally:
+            self._lock.release()
+    
+    def list_readers(self):
+        "Return a list of tuples: (reader name, implementing object)"
+        self._lock.acquire()
+        try:
+            if self._pcsc_readers is None:
+                self._enumerate()
+            return list(self._readers)
+        finally:
+            self._lock.release()
+    
+    def list_unwrapped_readers(self):
+        """Like list_readers(), but without the readers that are wrapped by another 
+        driver (e.g. the PC/SC side of an ACR122), so that each device appears only once"""
+        self._lock.acquire()
+        try:
+            if self._pcsc_readers is None:
+                self._enumerate()
+            wrapped = [ obj for name, obj, wrappers in self._pcsc_readers if len(wrappers) > 0 ]
+            return [ (name, obj) for name, obj in self._readers if obj not in wrapped ]
+        finally:
+            self._lock.release()
+    
+    def lookup(self, reader):
+        """Find a reader object by index (int or string of digits), full name or name prefix. 
+        Returns None if no reader matches."""
+        readers = self.list_readers()
+        
+        if isinstance(reader, int) or reader.isdigit():
+            reader = int(reader)
+            if reader < len(readers):
+                return readers[reader][1]
+            return None
+        
+        result = self._by_name.get(reader, None)
+        if result is None:
+            for name, obj in readers:
+                if str(name).startswith(reader):
+                    result = obj
+        return result
+    
+    def wait_for_card(self, timeout = None, ignore = ()):
+        """Wait on all PC/SC readers at once (with one SCardGetStatusChange call) until
+        a card is present in any of them, and return that reader's object. A card that 
+        is already present is found immediately. Returns None when timeout (in seconds,
+        None is forever) expires. Readers named in ignore are not watched, neither are 
+        readers that are wrapped by another driver (e.g. the ACR122, whose PN532 always
+        looks like a card to PC/SC)."""
+        self.list_readers()
+        self._lock.acquire()
+        try:
+            candidates = dict( [ (name, obj) for name, obj, wrappers in self._pcsc_readers
+                if len(wrappers) == 0 and name not in ignore ] )
+        finally:
+            self._lock.release()
+        if len(candidates) == 0:
+            return None
+        
+        hresult, hcontext = smartcard.scard.SCardEstablishContext(smartcard.scard.SCARD_SCOPE_USER)
+        if hresult != smartcard.scard.SCARD_S_SUCCESS:
+            raise smartcard.pcsc.PCSCExceptions.EstablishContextException(hresult)
+        try:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            
+            ## The first call only fetches the current state of all readers
+            states = [ (name, smartcard.scard.SCARD_STATE_UNAWARE) for name in candidates.keys() ]
+            wait = 0
+            while True:
+                hresult, states = smartcard.scard.SCardGetStatusChange(hcontext, wait, states)
+                if hresult == smartcard.scard.SCARD_E_TIMEOUT:
+                    return None
+                if hresult != smartcard.scard.SCARD_S_SUCCESS:
+                    raise smartcard.Exceptions.CardRequestException, "Failed to get status change: %s" % (
+                        smartcard.scard.SCardGetErrorMessage(hresult) )
+                
+                for name, state, atr in states:
+                    if state & smartcard.scard.SCARD_STATE_PRESENT and not state & (
+                            smartcard.scard.SCARD_STATE_MUTE | smartcard.scard.SCARD_STATE_EXCLUSIVE):
+                        return candidates[name]
+                
+                states = [ (name, state & ~smartcard.scard.SCARD_STATE_CHANGED) for name, state, atr in states ]
+                if timeout is None:
+                    wait = smartcard.scard.INFINITE
+                else:
+                    wait = int( (deadline - time.time()) * 1000 )
+                    if wait <= 0:
+                        return None
+        finally:
+            smartcard.scard.SCardReleaseContext(hcontext)
+    
+    def start_monitoring(self):
+        "Start tracking reader insertion and removal through a pyscard ReaderMonitor"
+        if self._monitor is not None:
+            return
+        try:
+            import smartcard.ReaderMonitoring
+            self._monitor = smartcard.ReaderMonitoring.ReaderMonitor()
+            self._monitor.addObserver(self)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except:
+            self._monitor = None
+    
+    def stop_monitoring(self):
+        if self._monitor is not None:
+            self._monitor.deleteObserver(self)
+            self._monitor = None
+    
+    def update(self, observable, (added, removed)):
+        "Called by the ReaderMonitor with lists of added and removed pyscard readers"
+        self._lock.acquire()
+        try:
+            if self._pcsc_readers is None:
+                return
+            removed = [ str(r) for r in removed ]
+            known = [ name for name, obj, wrappers in self._pcsc_readers ]
+            
+            self._pcsc_readers = [ e for e in self._pcsc_readers if e[0] not in removed ]
+            self._pcsc_readers.extend( [ self._wrap(r) for r in added if str(r) not in known ] )
+            self._rebuild()
+        finally:
+            self._lock.release()
+
+reader_registry = Reader_Registry()
+
 def list_readers():
     "Collect readers from all known drivers"
-    readers = PCSC_Reader.list_readers()
-    readers.extend( ACR122_Reader.list_readers() )
-    return readers
+    return reader_registry.list_readers()
 
-def connect_to(reader):
-    "Open the connection to a reader"
-    
-    readerObject = None
-    readers = list_readers()
+def wait_for_card(timeout = None, ignore = ()):
+    """Wait for a card to be present in any PC/SC reader and return the reader object,
+    or None if timeout expired. See Reader_Registry.wait_for_card()."""
+    return reader_registry.wait_for_card(timeout, ignore)
+
+## Seconds connect_to("any") waits for a card before giving up
+WAIT_FOR_CARD_TIMEOUT = 30
+
+def connect_to(reader, timeout = None):
+    """Open the connection to a reader. reader may be "any" to use the
+    first reader that has a card in it, or "pn532:<device>" for a PN532 
+    on a serial port. With "any", wait at most timeout seconds (default:
+    WAIT_FOR_CARD_TIMEOUT) for a card to be inserted."""
     
-    if isinstance(reader, int) or reader.isdigit():
-        reader = int(reader)
-        readerObject = readers[reader][1]
+    if reader == "any":
+        if timeout is None:
+            timeout = WAIT_FOR_CARD_TIMEOUT
+        print "Waiting for a card in any reader ..."
+        readerObject = wait_for_card(timeout)
+        if readerObject is None:
+            raise smartcard.Exceptions.CardRequestTimeoutException, "No card in any reader after %s seconds" % timeout
+    elif isinstance(reader, str) and reader.startswith("pn532:"):
+        import pn532_uart
+        readerObject = pn532_uart.PN532_UART_Reader(reader[len("pn532:"):])
     else:
-        for i, name, obj in readers:
-            if str(name).startswith(reader):
-                readerObject = obj
+        readerObject = reader_registry.lookup(reader)
     
     if readerObject is None:
-        readerObject = readers[0][1]
+        readerObject = list_readers()[0][1]
     
     print "Using reader: %s" % readerObject.name
     
@@ -322,11 +1009,167 @@ def connect_to(reader):
     print "ATR:          %s" % utils.hexdump(readerObject.get_ATR(), short = True)
     return readerObject
 
+class Reader_Worker(threading.Thread):
+    """A thread owning exactly one reader. Jobs are taken from the job queue
+    and called as job(card, *args, **kwargs), the outcome is put on the result
+    queue as a tuple (job, result, exc_info, elapsed). exc_info is None if the 
+    job returned normally, result is None if it raised.
+    pyscard releases the GIL during SCardTransmit, so workers for different 
+    readers really do talk to their cards at the same time."""
+    
+    _STOP = object()
+    
+    def __init__(self, name, reader, card_factory = None):
+        threading.Thread.__init__(self, name = "Reader_Worker(%s)" % name)
+        self.setDaemon(True)
+        self.reader_name = name
+        self.reader = reader
+        self.card_factory = card_factory
+        self.card = None
+        self.jobs = Queue.Queue()
+        self.results = Queue.Queue()
+        
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.busy_time = 0.0
+    
+    def _connect(self):
+        if not self.reader.connect():
+            raise EnvironmentError, "Could not connect to a card in reader %s" % self.reader_name
+        if self.card_factory is None:
+            import cards
+            self.card = cards.new_card_object(self.reader)
+        else:
+            self.card = self.card_factory(self.reader)
+    
+    def run(self):
+        while True:
+            item = self.jobs.get()
+            if item is self._STOP:
+                break
+            
+            job, args, kwargs, results = item
+            start = time.time()
+            result = exc_info = None
+            try:
+                if self.card is None:
+                    self._connect()
+                result = job(self.card, *args, **kwargs)
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except:
+                exc_info = sys.exc_info()
+            elapsed = time.time() - start
+            
+            self.busy_time = self.busy_time + elapsed
+            if exc_info is None:
+                self.jobs_done = self.jobs_done + 1
+            else:
+                self.jobs_failed = self.jobs_failed + 1
+            
+            if results is None:
+                self.results.put( (job, result, exc_info, elapsed) )
+            else:
+                ## Private queue of a run_on_all() call
+                results.put( (self.reader_name, (job, result, exc_info, elapsed)) )
+        
+        if self.card is not None:
+            try:
+                self.reader.disconnect()
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except:
+                pass
+            self.card = None
+    
+    def stop(self):
+        self.jobs.put(self._STOP)
+
+class Session_Manager(object):
+    """Opens a set of readers (by default all of them) with one Reader_Worker 
+    thread each and dispatches job functions to every card concurrently.
+    
+    Usage:
+        m = Session_Manager()
+        m.start()
+        print m.run_on_all(lambda card: card.get_atr())
+        print m.get_stats()
+        m.stop()"""
+    
+    def __init__(self, readers = None, card_factory = None):
+        """readers is a list of (name, reader object) tuples as returned by 
+        list_readers(). When it is not given all readers are used, except those
+        that are wrapped by another driver (e.g. the PC/SC side of an ACR122):
+        two workers must not talk to the same device. card_factory is called with 
+        the reader object to create the card object that is handed to the jobs, 
+        default is cards.new_card_object."""
+        if readers is None:
+            readers = reader_registry.list_unwrapped_readers()
+        self.workers = [Reader_Worker(name, obj, card_factory) for name, obj in readers]
+        self._start_time = None
+        self._stop_time = None
+    
+    def start(self):
+        self._start_time = time.time()
+        self._stop_time = None
+        for worker in self.workers:
+            worker.start()
+    
+    def stop(self, timeout = None):
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join(timeout)
+        self._stop_time = time.time()
+    
+    def get_result_queues(self):
+        "Return a dictionary mapping reader names to their result queues"
+        return dict( [ (worker.reader_name, worker.results) for worker in self.workers ] )
+    
+    def dispatch(self, job, *args, **kwargs):
+        """Queue job(card, *args, **kwargs) on every reader and return immediately.
+        The results will appear on the per-reader result queues."""
+        for worker in self.workers:
+            worker.jobs.put( (job, args, kwargs, None) )
+    
+    def run_on_all(self, job, *args, **kwargs):
+        """Run job(card, *args, **kwargs) on every reader concurrently and wait for all 
+        of them. Returns a dictionary mapping reader names to (job, result, exc_info, elapsed) 
+        tuples. The results are collected on a private queue, the per-reader result 
+        queues (and any results of dispatch() waiting there) are not touched."""
+        results = Queue.Queue()
+        for worker in self.workers:
+            worker.jobs.put( (job, args, kwargs, results) )
+        return dict( [ results.get() for worker in self.workers ] )
+    
+    def get_stats(self):
+        "Return a dictionary with aggregate throughput statistics over all readers"
+        if self._start_time is None:
+            wall_time = 0.0
+        else:
+            wall_time = (self._stop_time or time.time()) - self._start_time
+        
+        done = sum( [worker.jobs_done for worker in self.workers] )
+        failed = sum( [worker.jobs_failed for worker in self.workers] )
+        
+        return {
+            "readers": len(self.workers),
+            "jobs_done": done,
+            "jobs_failed": failed,
+            "wall_time": wall_time,
+            "busy_time": sum( [worker.busy_time for worker in self.workers] ),
+            "jobs_per_second": wall_time > 0 and (done + failed) / wall_time or 0.0,
+            "per_reader": dict( [ (worker.reader_name, 
+                    {"jobs_done": worker.jobs_done, "jobs_failed": worker.jobs_failed, "busy_time": worker.busy_time}
+                ) for worker in self.workers] ),
+        }
+
 class CommandLineArgumentHelper:
-    OPTIONS = "r:l"
-    LONG_OPTIONS = ["reader=", "list-readers"]
+    OPTIONS = "r:lw:"
+    LONG_OPTIONS = ["reader=", "list-readers", "wait="]
     exit_now = False
     reader = None
+    timeout = None
     
     def connect(self):
         "Open the connection to a card"
@@ -334,7 +1177,7 @@ class CommandLineArgumentHelper:
         if self.reader is None:
             self.reader = 0
         
-        return connect_to(self.reader)
+        return connect_to(self.reader, self.timeout)
     
     def getopt(self, argv, opts="", long_opts=[]):
         "Wrapper around getopt.gnu_getopt. Handles common arguments, returns everything else."
@@ -349,6 +1192,8 @@ class CommandLineArgumentHelper:
                 for i, (name, obj) in enumerate(list_readers()):
                     print "%i: %s" % (i,name)
                 self.exit_now = True
+            elif option in ("-w","--wait"):
+                self.timeout = float(value)
             else:
                 unrecognized.append( (option, value) )
         
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Micro-benchmark for the TLV parser in TLV_utils.py.
+
+Uses two synthetic structures: one shaped like a passport DG2 (a few nested
+templates around a large image) and one with many small elements in nested
+sequences, like an SOD or a certificate list.
+Run as: python tlv_benchmark.py [number of iterations]"""
+
+import sys, timeit
+
+SETUP = """
+import TLV_utils
+
+def tlv(tag, value):
+    return TLV_utils.pack( [(tag, len(value), value)] )
+
+image = "".join([chr(i % 251) for i in range(30000)])
+DG2 = tlv(0x75, tlv(0x7F61, tlv(0x02, "\\x01") + tlv(0x7F60,
+    tlv(0xA1, tlv(0x80, "\\x01\\x01") + tlv(0x87, "\\x01\\x01") + tlv(0x88, "\\x00\\x08"))
+    + tlv(0x5F2E, image) )))
+
+items = "".join([tlv(0x30, tlv(0x02, chr(i % 256)) + tlv(0x04, "\\xaa" * 20)) for i in range(1000)])
+WIDE = tlv(0x77, tlv(0x30, tlv(0xA0, tlv(0x30, items))))
+LARGE = items * 10
+WIDE_INDEX = TLV_utils.lazy_unpack(WIDE).get_index()
+"""
+
+CASES = [
+    ("unpack DG2 (30 KB)", "TLV_utils.unpack(DG2)"),
+    ("decode DG2 (30 KB)", "TLV_utils.decode(DG2)"),
+    ("tlv_find_tag 5F2E in DG2", "TLV_utils.tlv_find_tag(TLV_utils.unpack(DG2), 0x5F2E)"),
+    ("unpack 1000 sequences (27 KB)", "TLV_utils.unpack(WIDE)"),
+    ("decode 1000 sequences (27 KB)", "TLV_utils.decode(WIDE)"),
+    ("tlv_find_tag 04 in sequences", "TLV_utils.tlv_find_tag(TLV_utils.unpack(WIDE), 0x04)"),
+    ("unpack 10000 sequences (270 KB)", "TLV_utils.unpack(LARGE)"),
+    ("lazy find 5F2E in DG2", "TLV_utils.lazy_unpack(DG2).find(0x5F2E, 1)[0].value"),
+    ("lazy find first 04 in sequences", "TLV_utils.lazy_unpack(WIDE).find(0x04, 1)[0].value"),
+    ("lazy find 04 in sequences", "TLV_utils.lazy_unpack(WIDE).find(0x04)"),
+    ("build index of sequences", "TLV_utils.lazy_unpack(WIDE).get_index()"),
+    ("index find 04 in sequences", "WIDE_INDEX.find(0x04)"),
+    ("index query 77/30/A0/30/30", "WIDE_INDEX.query('77/30/A0/30/30')"),
+]
+
+def run(number):
+    print "%-34s %12s" % ("", "ms per call")
+    for name, statement in CASES:
+        best = min(timeit.repeat(statement, SETUP, repeat = 3, number = number))
+        print "%-34s %12.3f" % (name, best / number * 1e3)
+
+if __name__ == "__main__":
+    number = 20
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+    run(number)
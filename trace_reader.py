@@ -0,0 +1,199 @@
+"""Record and replay of APDU sessions.
+
+A Recording_Reader wraps any other reader object and writes every transceive()
+(together with connect, ATR and disconnect) to a compact binary trace file. A
+Replay_Reader reads such a file and plays the card side back at full speed, so
+that the host side (drivers, secure messaging, TLV parsing) can be profiled and
+field bugs reproduced without a card.
+
+Trace format: The magic string, then a sequence of records. Each record starts
+with the header RECORD_HEADER (type, time since start of recording, duration,
+length of the first and of the second part) followed by both parts:
+    RECORD_CONNECT:    ATR, reader name
+    RECORD_EXCHANGE:   command APDU, response APDU
+    RECORD_DISCONNECT: (empty), (empty)"""
+
+import struct, time, readers, utils
+
+MAGIC = "CFTRACE\x01"
+RECORD_HEADER = ">cdfII"
+RECORD_HEADER_LENGTH = struct.calcsize(RECORD_HEADER)
+
+RECORD_CONNECT = "C"
+RECORD_EXCHANGE = "X"
+RECORD_DISCONNECT = "D"
+
+class Trace_Writer(object):
+    def __init__(self, fp):
+        self.fp = fp
+        self.start = time.time()
+        self.fp.write(MAGIC)
+    
+    def write(self, type, start, duration, first = "", second = ""):
+        self.fp.write( struct.pack(RECORD_HEADER, type, start - self.start, duration, len(first), len(second)) )
+        self.fp.write(first)
+        self.fp.write(second)
+    
+    def close(self):
+        self.fp.close()
+
+def read_trace(fp):
+    """Iterate over the records in a trace file, yielding tuples
+    (type, timestamp, duration, first, second)"""
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError, "Not an APDU trace file"
+    
+    while True:
+        header = fp.read(RECORD_HEADER_LENGTH)
+        if len(header) == 0:
+            break
+        if len(header) != RECORD_HEADER_LENGTH:
+            raise ValueError, "Truncated trace file"
+        type, timestamp, duration, first_len, second_len = struct.unpack(RECORD_HEADER, header)
+        first = fp.read(first_len)
+        second = fp.read(second_len)
+        if len(first) != first_len or len(second) != second_len:
+            raise ValueError, "Truncated trace file"
+        yield type, timestamp, duration, first, second
+
+class Recording_Reader(readers.Smartcard_Reader):
+    """Wraps a reader object and records everything that passes through it.
+    Can either be used in place of the original reader from the start, or be
+    put in place of an already connected reader (the ATR is recorded at once)."""
+    
+    def __init__(self, parent, fp):
+        self._parent = parent
+        self._writer = Trace_Writer(fp)
+        self._name = parent.name
+        try:
+            atr = parent.get_ATR()
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except:
+            atr = ""
+        if atr:
+            self._writer.write(RECORD_CONNECT, time.time(), 0, atr, self._name)
+    
+    name = property(lambda self: self._name, None, None, "The human readable name of the reader")
+    parent = property(lambda self: self._parent, None, None, "The wrapped reader object")
+    CONNECTION_ERRORS = property(lambda self: self._parent.CONNECTION_ERRORS)
+    
+    def __getattr__(self, name):
+        ## Make reader specific extensions of the wrapped reader available (not recorded)
+        return getattr(self._parent, name)
+    
+    def _internal_connect(self):
+        start = time.time()
+        for result in self._parent._internal_connect():
+            if result is self._CONNECT_DONE:
+                self._writer.write(RECORD_CONNECT, start, time.time() - start, self._parent.get_ATR(), self._name)
+            yield result
+    
+    def get_ATR(self):
+        return self._parent.get_ATR()
+    
+    def begin_transaction(self, timeout = None):
+        self._parent.begin_transaction(timeout)
+    
+    def end_transaction(self):
+        self._parent.end_transaction()
+    
+    def reconnect(self, timeout = 5.0):
+        ## The transaction state lives in the wrapped reader, so it must do the reconnect
+        start = time.time()
+        result = self._parent.reconnect(timeout)
+        if result:
+            self._writer.write(RECORD_CONNECT, start, time.time() - start, self._parent.get_ATR(), self._name)
+        return result
+    
+    def get_statistics(self):
+        ## Keep counting in the wrapped reader, so that starting or stopping a trace doesn't lose the statistics
+        return self._parent.get_statistics()
+    
+    def transceive(self, data):
+        start = time.time()
+        response = self._parent.transceive(data)
+        self._writer.write(RECORD_EXCHANGE, start, time.time() - start, data, response)
+        return response
+    
+    def disconnect(self):
+        self._parent.disconnect()
+        self._writer.write(RECORD_DISCONNECT, time.time(), 0)
+    
+    def close(self):
+        "Close the trace file"
+        self._writer.close()
+
+class Replay_Reader(readers.Smartcard_Reader):
+    """Plays back a trace recorded by Recording_Reader. With strict set (the default)
+    every command must be identical to the recorded one, otherwise a ValueError is
+    raised; without it the recorded responses are returned in order no matter what
+    is sent. Normally the responses are returned immediately, set honour_timing to
+    reproduce the recorded durations."""
+    
+    def __init__(self, fp, strict = True, honour_timing = False):
+        self.records = list(read_trace(fp))
+        self.strict = strict
+        self.honour_timing = honour_timing
+        self._name = "Replay"
+        for record in self.records:
+            if record[0] == RECORD_CONNECT:
+                self._name = "Replay of %s" % record[4]
+                break
+        self.rewind()
+    
+    name = property(lambda self: self._name, None, None, "The human readable name of the reader")
+    
+    def rewind(self):
+        "Start again at the beginning of the trace"
+        self._position = 0
+        self._atr = ""
+    
+    def _next(self, types):
+        while self._position < len(self.records):
+            record = self.records[self._position]
+            self._position = self._position + 1
+            if record[0] in types:
+                return record
+        raise EOFError, "End of trace reached"
+    
+    def _internal_connect(self):
+        try:
+            record = self._next( (RECORD_CONNECT, ) )
+        except EOFError:
+            yield self._CONNECT_NO_CARD
+            return
+        self._atr = record[3]
+        yield self._CONNECT_DONE
+    
+    def get_ATR(self):
+        return self._atr
+    
+    def transceive(self, data):
+        record = self._next( (RECORD_EXCHANGE, ) )
+        if self.strict and record[3] != data:
+            raise ValueError, "Command does not match the trace at record %i:\nexpected %s\ngot      %s" % (
+                self._position - 1, utils.hexdump(record[3], short=True), utils.hexdump(data, short=True) )
+        if self.honour_timing and record[2] > 0:
+            time.sleep(record[2])
+        ## Statistics show the recorded durations, as if talking to the original card
+        self.get_statistics().record(data, record[4], record[2])
+        return record[4]
+    
+    def disconnect(self):
+        pass
+
+if __name__ == "__main__":
+    import sys
+    fp = file(sys.argv[1], "rb")
+    try:
+        for type, timestamp, duration, first, second in read_trace(fp):
+            if type == RECORD_CONNECT:
+                print "%10.4f  Connect to %s, ATR %s" % (timestamp, second, utils.hexdump(first, short=True))
+            elif type == RECORD_DISCONNECT:
+                print "%10.4f  Disconnect" % timestamp
+            else:
+                print "%10.4f  %0.4fs >> %s" % (timestamp, duration, utils.hexdump(first, short=True))
+                print "%10s  %7s << %s" % ("", "", utils.hexdump(second, short=True))
+    finally:
+        fp.close()
@@ -1,4 +1,4 @@
-import string, binascii, sys, re, inspect
+import string, binascii, sys, re, collections
 
 def represent_binary_fancy(len, value, mask = 0):
     result = []
@@ -37,6 +37,27 @@ def parse_binary(value, bytemasks, verbose = False, value_len = 8):
     return result
 
 _myprintable = " " + string.letters + string.digits + string.punctuation
+_printable_table = "".join([chr(i) in _myprintable and chr(i) or "." for i in range(256)])
+_hex_table = ["%02x" % i for i in range(256)]
+
+def _hexable(data):
+    return " ".join([_hex_table[ord(e)] for e in data])
+
+def _printable(data):
+    return data.translate(_printable_table)
+
+def hexdump_lines(data, linelen = 16, offset = 0):
+    """Generates the lines of the hexdump of data (as in hexdump()) one at a time,
+    so that large buffers can be written to a stream without building the whole
+    dump as one string first."""
+    if not isinstance(data, str):
+        data = "".join(data)
+    
+    FORMATSTRING = "%04x:  %-"+ str(linelen*3) +"s  %-"+ str(linelen) +"s"
+    for pos in xrange(0, len(data), linelen):
+        line = data[pos:pos+linelen]
+        yield FORMATSTRING % (pos+offset, _hexable(line), _printable(line))
+
 def hexdump(data, indent = 0, short = False, linelen = 16, offset = 0):
     r"""Generates a nice hexdump of data and returns it. Consecutive lines will 
     be indented with indent spaces. When short is true, will instead generate 
@@ -47,26 +68,12 @@ def hexdump(data, indent = 0, short = False, linelen = 16, offset = 0):
     '0000:  00 41                                             .A              '
     hexdump('\x00\x41', short=True) -> '00 41 (.A)'"""
     
-    def hexable(data):
-        return " ".join([binascii.b2a_hex(a) for a in data])
-    
-    def printable(data):
-        return "".join([e in _myprintable and e or "." for e in data])
-    
     if short:
-        return "%s (%s)" % (hexable(data), printable(data))
+        if not isinstance(data, str):
+            data = "".join(data)
+        return "%s (%s)" % (_hexable(data), _printable(data))
     
-    FORMATSTRING = "%04x:  %-"+ str(linelen*3) +"s  %-"+ str(linelen) +"s"
-    result = ""
-    (head, tail) = (data[:linelen], data[linelen:])
-    pos = 0
-    while len(head) > 0:
-        if pos > 0:
-            result = result + "\n%s" % (' ' * indent)
-        result = result + FORMATSTRING % (pos+offset, hexable(head), printable(head))
-        pos = pos + len(head)
-        (head, tail) = (tail[:linelen], tail[linelen:])
-    return result
+    return ("\n" + " " * indent).join(hexdump_lines(data, linelen, offset))
 
 LIFE_CYCLES = {0x01: "Load file = loaded",
     0x03: "Applet instance / security domain = Installed",
@@ -75,69 +82,204 @@ LIFE_CYCLES = {0x01: "Load file = loaded",
     0x7F: "Card manager = Locked; Applet instance / security domain = Blocked",
     0xFF: "Applet instance = Locked"}
 
+PRIVILEGES = [ (1<<7, "security domain"),
+    (1<<6, "DAP DES verification"),
+    (1<<5, "delegated management"),
+    (1<<4, "card locking"),
+    (1<<3, "card termination"),
+    (1<<2, "default selected"),
+    (1<<1, "global PIN modification"),
+    (1<<0, "mandated DAP verification") ]
+
+class Registry_Entry(object):
+    "One entry of a card's GlobalPlatform/OpenPlatform registry, as returned by GET STATUS"
+    
+    def __init__(self, aid, life_cycle, privileges):
+        self.aid = aid
+        self.life_cycle = life_cycle
+        self.privileges = privileges
+    
+    def get_life_cycle_name(self):
+        return LIFE_CYCLES.get(self.life_cycle, "unknown or invalid state")
+    
+    def get_privilege_names(self):
+        return [name for (bit, name) in PRIVILEGES if self.privileges & bit]
+    
+    def format(self):
+        privileges = ", ".join(self.get_privilege_names()) or "N/A"
+        return "\n".join( [
+            "aid length:       %i (%x)" % (len(self.aid), len(self.aid)),
+            "aid:              %s" % hexdump(self.aid, indent = 18, short=True),
+            "life cycle state: %x (%s)" % (self.life_cycle, self.get_life_cycle_name()),
+            "privileges:       %x (%s)\n" % (self.privileges, privileges),
+        ] )
+    
+    def __repr__(self):
+        return "%s(%r, 0x%02x, 0x%02x)" % (self.__class__.__name__, self.aid, self.life_cycle, self.privileges)
+
+def parse_registry(data, result = None):
+    """Parses the data of the Response APDU(s) of a GetStatus command into a list
+    of Registry_Entry objects. If result is given, the entries are appended to it.
+    Raises ValueError if an entry is truncated."""
+    if result is None:
+        result = []
+    
+    pos, end = 0, len(data)
+    while pos < end:
+        lgth = ord(data[pos])
+        if pos + lgth + 3 > end:
+            raise ValueError, "Truncated GetStatus entry at offset %i" % pos
+        result.append( Registry_Entry(data[pos+1:pos+1+lgth], ord(data[pos+1+lgth]), ord(data[pos+2+lgth])) )
+        pos = pos + lgth + 3
+    
+    return result
+
 def parse_status(data):
-    """Parses the Response APDU of a GetStatus command."""
-    def parse_segment(segment):
-        def parse_privileges(privileges):
-            if privileges == 0x0:
-                return "N/A"
-            else:
-                privs = []
-                if privileges & (1<<7):
-                    privs.append("security domain")
-                if privileges & (1<<6):
-                    privs.append("DAP DES verification")
-                if privileges & (1<<5):
-                    privs.append("delegated management")
-                if privileges & (1<<4):
-                    privs.append("card locking")
-                if privileges & (1<<3):
-                    privs.append("card termination")
-                if privileges & (1<<2):
-                    privs.append("default selected")
-                if privileges & (1<<1):
-                    privs.append("global PIN modification")
-                if privileges & (1<<0):
-                    privs.append("mandated DAP verification")
-                return ", ".join(privs)
-        
-        lgth = ord(segment[0])
-        aid = segment[1:1+lgth]
-        lifecycle = ord(segment[1+lgth])
-        privileges = ord(segment[1+lgth+1])
-        
-        print "aid length:       %i (%x)" % (lgth, lgth)
-        print "aid:              %s" % hexdump(aid, indent = 18, short=True)
-        print "life cycle state: %x (%s)" % (lifecycle, LIFE_CYCLES.get(lifecycle, "unknown or invalid state"))
-        print "privileges:       %x (%s)\n" % (privileges, parse_privileges(privileges))
+    """Parses the Response APDU of a GetStatus command and prints it."""
+    for entry in parse_registry(data):
+        print entry.format()
+
+def get_historical_bytes(atr):
+    "Return the historical bytes from a binary ATR string"
+    if len(atr) < 2:
+        return ""
+    count = ord(atr[1]) & 0x0f
+    y = ord(atr[1]) >> 4
+    pos = 2
+    while y:
+        pos = pos + (y & 1) + (y >> 1 & 1) + (y >> 2 & 1) + (y >> 3 & 1)
+        if y & 0x08 and pos <= len(atr):
+            y = ord(atr[pos-1]) >> 4
+        else:
+            y = 0
+    return atr[pos:pos+count]
 
+def parse_compact_tlv(historical):
+    """Parse the COMPACT-TLV data objects in the historical bytes of an ATR
+    (ISO 7816-4 section 8.1.1) into a dictionary tag -> value. Returns an empty
+    dictionary if the historical bytes are not in the COMPACT-TLV format."""
+    result = {}
+    if len(historical) == 0:
+        return result
+    category = ord(historical[0])
+    if category == 0x00:
+        data = historical[1:-3] ## Followed by a mandatory status indicator
+    elif category == 0x80:
+        data = historical[1:]
+    else:
+        return result
+    
     pos = 0
     while pos < len(data):
-        lgth = ord(data[pos])+3
-        segment = data[pos:pos+lgth]
-        parse_segment(segment)
-        pos = pos + lgth
+        tag, length = ord(data[pos]) >> 4, ord(data[pos]) & 0x0f
+        result[tag] = data[pos+1:pos+1+length]
+        pos = pos + 1 + length
+    return result
+
+def has_extended_length(atr):
+    """Return True if the card capabilities in the ATR historical bytes announce
+    support for extended Lc and Le fields"""
+    capabilities = parse_compact_tlv(get_historical_bytes(atr)).get(0x7, "")
+    return len(capabilities) >= 3 and (ord(capabilities[2]) & 0x40) != 0
 
 def _unformat_hexdump(dump):
     hexdump = " ".join([line[7:54] for line in dump.splitlines()])
     return binascii.a2b_hex("".join([e != " " and e or "" for e in hexdump]))
 
+def _make_field_getter(prop):
+    "Getter for the slot _<prop>, falling back to the class attribute _DEFAULT_<prop>"
+    attr, default = "_"+prop, "_DEFAULT_"+prop
+    def getter(self):
+        try:
+            return getattr(self, attr)
+        except AttributeError:
+            return getattr(self, default, None)
+    return getter
+
+def _make_field_deleter(prop):
+    attr = "_"+prop
+    return lambda self: delattr(self, attr)
+
 def _make_byte_property(prop):
     "Make a byte property(). This is meta code."
-    return property(lambda self: getattr(self, "_"+prop, getattr(self, "_DEFAULT_"+prop, None)),
-            lambda self, value: self._setbyte(prop, value), 
-            lambda self: delattr(self, "_"+prop),
+    attr = "_"+prop
+    def setter(self, value):
+        if type(value) is int:
+            setattr(self, attr, value)
+        else:
+            self._setbyte(prop, value)
+    return property(_make_field_getter(prop), setter, _make_field_deleter(prop),
             "The %s attribute of the APDU" % prop)
 
 def _make_bool_property(prop):
     "Make a bool property(). This is meta code."
-    return property(lambda self: getattr(self, "_"+prop, getattr(self, "_DEFAULT_"+prop, None)),
+    return property(_make_field_getter(prop),
             lambda self, value: self._setbool(prop, value), 
-            lambda self: delattr(self, "_"+prop),
+            _make_field_deleter(prop),
             "The %s attribute of the APDU" % prop)
 
+_MISSING = object()
+_field_copiers = {}
+_field_savers = {}
+
+def _get_field_names(cls):
+    "Return the names of all fields (the __slots__ of cls and its base classes)"
+    names = []
+    for c in cls.__mro__:
+        for name in c.__dict__.get("__slots__", ()):
+            if name not in ("__dict__", "__weakref__") and name not in names:
+                names.append(name)
+    return names
+
+def _get_field_copier(cls):
+    """Return a function copy(target, source) that copies all fields (the 
+    __slots__ of cls and its base classes) that are set in source. The function
+    is compiled once per class, so that copying a template only costs a few
+    attribute accesses. This is meta code."""
+    try:
+        return _field_copiers[cls]
+    except KeyError:
+        code = ["def copy(target, source, getattr=getattr, missing=_MISSING):"]
+        for name in _get_field_names(cls):
+            code.append("    value = getattr(source, %r, missing)" % name)
+            code.append("    if value is not missing: target.%s = value" % name)
+        code.append("    pass")
+        
+        namespace = {"_MISSING": _MISSING}
+        exec "\n".join(code) in namespace
+        _field_copiers[cls] = namespace["copy"]
+        return namespace["copy"]
+
+def _get_field_saver(cls):
+    """Return a pair of functions save(source) -> values and restore(target, values)
+    that take a snapshot of all fields of an instance of cls as a tuple and put it
+    back, including unsetting fields that were not set. Compiled once per class
+    like _get_field_copier(). This is meta code."""
+    try:
+        return _field_savers[cls]
+    except KeyError:
+        names = _get_field_names(cls)
+        code = ["def save(source, getattr=getattr, missing=_MISSING):",
+            "    return (%s)" % "".join(["getattr(source, %r, missing), " % name for name in names]),
+            "def restore(target, values, missing=_MISSING):"]
+        for index, name in enumerate(names):
+            code.append("    if values[%i] is not missing: target.%s = values[%i]" % (index, name, index))
+            code.append("    elif hasattr(target, %r): del target.%s" % (name, name))
+        code.append("    pass")
+        
+        namespace = {"_MISSING": _MISSING}
+        exec "\n".join(code) in namespace
+        _field_savers[cls] = (namespace["save"], namespace["restore"])
+        return _field_savers[cls]
+
 class APDU(object):
-    "Base class for an APDU"
+    """Base class for an APDU
+    
+    The fields of all APDU classes are kept in __slots__, so creating and
+    copying APDUs (which happens for every command sent to the card) is cheap.
+    Instances still have a __dict__ for additional attributes (e.g. marks),
+    which is only allocated when it is actually used."""
+    __slots__ = ("_data", "__dict__", "__weakref__")
     
     def __init__(self, *args, **kwargs):
         """Creates a new APDU instance. Can be given positional parameters which 
@@ -156,7 +298,11 @@ class APDU(object):
         initbuff = list()
         
         if len(args) == 1 and isinstance(args[0], self.__class__):
-            self.parse( args[0].render() )
+            ## Copy the fields directly instead of going through render() and parse()
+            _get_field_copier(args[0].__class__)(self, args[0])
+        elif len(args) == 1 and isinstance(args[0], str):
+            ## Fast path for a complete binary APDU, e.g. straight from a reader's transceive()
+            self.parse( args[0] )
         else:
             for arg in args:
                 if type(arg) == str:
@@ -183,13 +329,47 @@ class APDU(object):
             if value is not None:
                 setattr(self, name, value)
     
+    def with_params(self, **kwargs):
+        """Return a copy of this APDU with some fields replaced. This is the same
+        as calling the constructor with this APDU and keyword arguments, e.g. 
+        C_APDU(template, p1=0x12), but skips the argument handling, so it is 
+        the preferred way to build commands from the APDU_* class attributes
+        of the card drivers: self.APDU_READ_BINARY.with_params(p1=0x12)"""
+        cls = self.__class__
+        result = object.__new__(cls)
+        _get_field_copier(cls)(result, self)
+        for (name, value) in kwargs.items():
+            if value is not None:
+                setattr(result, name, value)
+        return result
+    
+    def copy(self):
+        """Return an exact copy of this APDU. Unlike the copy constructor and
+        with_params() this also copies the attributes that are not APDU fields
+        (e.g. the marks of a fancy APDU)."""
+        result = object.__new__(self.__class__)
+        _get_field_copier(self.__class__)(result, self)
+        result.__dict__.update(self.__dict__)
+        return result
+    
+    def save_fields(self):
+        """Return a snapshot of the APDU fields, for restore_fields(). This is cheaper
+        than copy(): no new APDU is created and the other attributes are not touched."""
+        return _get_field_saver(self.__class__)[0](self)
+    
+    def restore_fields(self, values):
+        "Put back the APDU fields from a snapshot taken with save_fields()"
+        _get_field_saver(self.__class__)[1](self, values)
+    
     def _getdata(self):
         return getattr(self, "_data", "")
     def _setdata(self, value): 
         if isinstance(value, str):
-            self._data = "".join([e for e in value])
+            self._data = value
+        elif isinstance(value, (bytearray, buffer)):
+            self._data = str(value)
         elif isinstance(value, list):
-            self._data = "".join([chr(int(e)) for e in value])
+            self._data = str(bytearray(value))
         else:
             raise ValueError, "'data' attribute can only be a str or a list of int, not %s" % type(value)
         self.Lc = len(value)
@@ -206,14 +386,14 @@ class APDU(object):
         elif isinstance(value, str):
             setattr(self, "_"+name, ord(value))
         else:
-            raise ValueError, "'%s' attribute can only be a byte, that is: int or str, not %s" % (namelower, type(value))
+            raise ValueError, "'%s' attribute can only be a byte, that is: int or str, not %s" % (name.lower(), type(value))
 
     def _setbool(self, name, value):
         #print "setbool(%r, %r)" % (name, value)
         if isinstance(value, bool):
             setattr(self, "_"+name, value)
         else:
-            raise ValueError, "'%s' attribute can only be a bool, not %s" % (namelower, type(value))
+            raise ValueError, "'%s' attribute can only be a bool, not %s" % (name.lower(), type(value))
 
     def _format_parts(self, fields):
         "utility function to be used in __str__ and __repr__"
@@ -245,47 +425,50 @@ class APDU(object):
 
 class C_APDU(APDU):
     "Class for a command APDU"
+    __slots__ = ("_CLA", "_INS", "_P1", "_P2", "_Lc", "_Le", "_Ext")
     
     def parse(self, apdu):
         "Parse a full command APDU and assign the values to our object, overwriting whatever there was."
         
-        apdu = map( lambda a: (isinstance(a, str) and (ord(a),) or (a,))[0], apdu)
-        apdu = apdu + [0] * max(4-len(apdu), 0)
-        
-        self.CLA, self.INS, self.P1, self.P2 = apdu[:4] # case 1, 2, 3, 4
-	self.ext = False
-        if len(apdu) == 5:                              # case 2
-            self.Le = apdu[-1]
-            self.data = ""
-	elif len(apdu) == 7 and apdu[4] == 0x00:	# case 2 extended
-	    self.Le = apdu[6]
-	    self.Le += apdu[5] << 8
-	    self.data = ""
-	    self.ext = True
-        elif len(apdu) > 5:                             # case 3, 4
-	    if apdu[4] == 0x00:				# lc extended
-	        self.Lc = apdu[6]
-		self.Lc += apdu[5] << 8
-                self.data = apdu[7:7 + self.Lc]
-		self.ext = True
-	        if 4 + 3 + self.Lc + 2 == len(apdu):	# case 4 extended
-	            self.Le = apdu[-1]
-		    self.Le += apdu[-2] << 8 #[7 + self.Lc:]
-                elif 4 + 3 + self.Lc != len(apdu):	# case 3 extended
-	            raise ValueError, "Invalid extended Lc value. Is %s, should be %s or %s" % (self.Lc,
-                        len(apdu) - 7, len(apdu) - (7 + 2))
-	    else:
-                self.Lc = apdu[4]
-                if len(apdu) == 5 + self.Lc:            # case 3
-                    self.data = apdu[5:]
-                elif len(apdu) == 5 + self.Lc + 1:      # case 4
-                    self.data = apdu[5:-1]
-                    self.Le = apdu[-1]
+        if not isinstance(apdu, str):
+            apdu = "".join( [isinstance(a, str) and a or chr(a) for a in apdu] )
+        if len(apdu) < 4:
+            apdu = apdu + "\x00" * (4-len(apdu))
+        length = len(apdu)
+        
+        self._CLA, self._INS, self._P1, self._P2 = [ord(e) for e in apdu[:4]] # case 1, 2, 3, 4
+        self._Ext = False
+        if length == 5:                                 # case 2
+            self._Le = ord(apdu[4])
+            self._data, self._Lc = "", 0
+        elif length == 7 and apdu[4] == "\x00":         # case 2 extended
+            self._Le = (ord(apdu[5]) << 8) + ord(apdu[6])
+            self._data, self._Lc = "", 0
+            self._Ext = True
+        elif length > 5:                                # case 3, 4
+            if apdu[4] == "\x00":                       # lc extended
+                data = apdu[7:7 + (ord(apdu[5]) << 8) + ord(apdu[6])]
+                lc = len(data)
+                self._Ext = True
+                if 4 + 3 + lc + 2 == length:            # case 4 extended
+                    self._Le = (ord(apdu[-2]) << 8) + ord(apdu[-1])
+                elif 4 + 3 + lc != length:              # case 3 extended
+                    raise ValueError, "Invalid extended Lc value. Is %s, should be %s or %s" % (lc,
+                        length - 7, length - (7 + 2))
+                self._data, self._Lc = data, lc
+            else:
+                lc = ord(apdu[4])
+                if length == 5 + lc:                    # case 3
+                    self._data = apdu[5:]
+                elif length == 5 + lc + 1:              # case 4
+                    self._data = apdu[5:-1]
+                    self._Le = ord(apdu[-1])
                 else:
-                    raise ValueError, "Invalid Lc value. Is %s, should be %s or %s" % (self.Lc,
-                        len(apdu) - 5, len(apdu) - (5 + 1))
+                    raise ValueError, "Invalid Lc value. Is %s, should be %s or %s" % (lc,
+                        length - 5, length - (5 + 1))
+                self._Lc = lc
         else:                                           # case 1
-            self.data = ""
+            self._data, self._Lc = "", 0
     
     CLA = _make_byte_property("CLA"); cla = CLA
     INS = _make_byte_property("INS"); ins = INS
@@ -306,29 +489,27 @@ class C_APDU(APDU):
     
     def render(self):
         "Return this APDU as a binary string"
-        buffer = []
-        
-        for i in self.CLA, self.INS, self.P1, self.P2:
-            buffer.append(chr(i))
+        data = self.data
+        buffer = [chr(self.CLA), chr(self.INS), chr(self.P1), chr(self.P2)]
         
-	if self.Ext == False:
-            if len(self.data) > 0:
+        if not self.Ext:
+            if len(data) > 0:
                 buffer.append(chr(self.Lc))
-                buffer.append(self.data)
-        
+                buffer.append(data)
+            
             if hasattr(self, "_Le"):
                 buffer.append(chr(self.Le))
-	else:
-	    if len(self.data) > 0:
-	        buffer.append(chr(0x0))
-		buffer.append(chr(self.Lc >> 8))
+        else:
+            if len(data) > 0:
+                buffer.append(chr(0x0))
+                buffer.append(chr(self.Lc >> 8))
                 buffer.append(chr(self.Lc & 0xFF))
-                buffer.append(self.data)
-        
+                buffer.append(data)
+            
             if hasattr(self, "_Le"):
-	        if len(self.data) == 0:
-	            buffer.append(chr(0x0))
-		buffer.append(chr(self.Le >> 8))
+                if len(data) == 0:
+                    buffer.append(chr(0x0))
+                buffer.append(chr(self.Le >> 8))
                 buffer.append(chr(self.Le & 0xFF))
         
         return "".join(buffer)
@@ -362,137 +543,168 @@ class C_APDU(APDU):
     _fancyapduregex = re.compile(r'^\s*([0-9a-f]{2}\s*){4,}\s*((xx|yy)\s*)?(([0-9a-f]{2}|:|\)|\(|\[|\])\s*)*$', re.I)
     @staticmethod
     def parse_fancy_apdu(ext, *args):
-        apdu_string = " ".join(args)
-        if not C_APDU._fancyapduregex.match(apdu_string):
-            raise ValueError
-        
-        apdu_string = apdu_string.lower()
-        have_le = False
-        pos = apdu_string.find("xx")
-        if pos == -1:
-            pos = apdu_string.find("yy")
-            have_le = True
-        
-        apdu_head = ""
-        apdu_tail = apdu_string
-        if pos != -1:
-            apdu_head = apdu_string[:pos]
-            apdu_tail = apdu_string[pos+2:]
-        
-        if apdu_head.strip() != "" and not C_APDU._apduregex.match(apdu_head):
-            raise ValueError
-        
-        class Node(list):
-            def __init__(self, parent = None, type = None):
-                list.__init__(self)
-                self.parent = parent
-                self.type = type
-            
-            def make_binary(self):
-                "Recursively transform hex strings to binary"
-                for index, child in enumerate(self):
-                    if isinstance(child,str):
-                        child = "".join( ("".join(child.split())).split(":") )
-                        assert len(child) % 2 == 0
-                        self[index] = binascii.a2b_hex(child)
-                    else:
-                        child.make_binary()
-            
-            def calculate_lengths(self):
-                "Recursively calculate lengths and insert length counts"
-                self.length = 0
-                index = 0
-                while index < len(self): ## Can't use enumerate() due to the insert() below
-                    child = self[index]
-                    
-                    if isinstance(child,str):
-                        self.length = self.length + len(child)
-                    else:
-                        child.calculate_lengths()
-			if child.length < 256:
-                            formatted_len = binascii.a2b_hex("%02x" % child.length) 
-			else:
-			    formatted_len = binascii.a2b_hex("%04x" % child.length)
-                        self.length = self.length + len(formatted_len) + child.length
-                        self.insert(index, formatted_len)
-                        index = index + 1
-                    
-                    index = index + 1
-            
-            def flatten(self, offset = 0, ignore_types=["("]):
-                "Recursively flatten, gather list of marks"
-                string_result = []
-                mark_result = []
-                for child in self:
-                    if isinstance(child,str):
-                        string_result.append(child)
-                        offset = offset + len(child)
-                    else:
-                        start = offset
-                        child_string, child_mark = child.flatten(offset, ignore_types)
-                        string_result.append(child_string)
-                        offset = end = offset + len(child_string)
-                        if not child.type in ignore_types:
-                            mark_result.append( (child.type, start, end) )
-                        mark_result.extend(child_mark)
-                
-                return "".join(string_result), mark_result
+        "Parse a fancy APDU string (see Fancy_APDU_Template) and return a new C_APDU"
+        return compile_fancy_apdu(ext, " ".join(args)).instantiate()
+
+class _Fancy_APDU_Node(list):
+    "A parenthesized part of a fancy APDU: a list of binary strings, placeholder names (unicode) and nodes"
+    def __init__(self, parent = None, type = None):
+        list.__init__(self)
+        self.parent = parent
+        self.type = type
+        self.static = None
+    
+    def prepare(self):
+        """Convert hex strings to binary and pre-render all parts that don't
+        contain placeholders. Return True if this node is completely static."""
+        static = True
+        for index, child in enumerate(self):
+            if isinstance(child, _Fancy_APDU_Node):
+                static = child.prepare() and static
+            elif isinstance(child, unicode):
+                static = False
+            else:
+                child = "".join( ("".join(child.split())).split(":") )
+                if len(child) % 2 != 0:
+                    raise ValueError, "Odd number of hex digits in fancy APDU"
+                self[index] = binascii.a2b_hex(child)
+        
+        if static:
+            self.static = self.render({})
+        return static
+    
+    def render(self, values, ignore_types = ("(", )):
+        """Return the binary contents of this node (with the lengths of all
+        sub-nodes inserted) and the list of marks, with offsets relative to
+        the start of this node."""
+        if self.static is not None:
+            return self.static
         
+        string_result = []
+        mark_result = []
+        offset = 0
+        for child in self:
+            if isinstance(child, _Fancy_APDU_Node):
+                child_string, child_marks = child.render(values, ignore_types)
+                length = len(child_string)
+                if length < 256:
+                    formatted_len = chr(length)
+                else:
+                    formatted_len = chr(length >> 8) + chr(length & 0xff)
+                string_result.append(formatted_len)
+                string_result.append(child_string)
+                start = offset + len(formatted_len)
+                offset = end = start + length
+                if not child.type in ignore_types:
+                    mark_result.append( (child.type, start, end) )
+                mark_result.extend( [(type, s + start, e + start) for (type, s, e) in child_marks] )
+            else:
+                if isinstance(child, unicode):
+                    child = values[str(child)]
+                string_result.append(child)
+                offset = offset + len(child)
+        
+        return "".join(string_result), mark_result
+
+class Fancy_APDU_Template(object):
+    """A fancy APDU string, compiled into an object that can be instantiated 
+    many times. Besides the normal fancy APDU syntax (hex bytes, xx or yy for
+    the length, () and [] for nested length fields) the template may contain
+    placeholders {name} anywhere, which are replaced by the binary strings given
+    to instantiate(). Lengths are calculated on instantiation, everything that 
+    doesn't depend on a placeholder is calculated once, here."""
+    
+    _tokenregex = re.compile(r'\{(\w+)\}|(xx|yy)|([0-9a-f:\s]+)|(.)', re.I)
+    
+    def __init__(self, ext, template):
+        self.ext = ext
+        self.template = template
+        
+        ## Check the syntax with the placeholders standing in for some bytes
+        plain = re.sub(r'\{\w+\}', "00000000", template)
+        if not C_APDU._fancyapduregex.match(plain):
+            raise ValueError, "Invalid fancy APDU %r" % template
         
-        tree = Node()
-        current = tree
+        self.head = []
+        self.have_le = False
+        self.have_length = False
+        self.tree = current = _Fancy_APDU_Node()
         allowed_parens = {"(": ")", "[":"]"}
         
-        for pos,char in enumerate(apdu_tail):
-            if char in (" ", "a", "b", "c", "d", "e", "f",":") or char.isdigit():
-                if len(current) > 0 and isinstance(current[-1],str):
-                    current[-1] = current[-1] + char
+        for match in self._tokenregex.finditer(template):
+            placeholder, length, hexdigits, char = match.groups()
+            if length is not None and not self.have_length:
+                if not C_APDU._apduregex.match( re.sub(r'\{\w+\}', "00000000", template[:match.start()]) ):
+                    raise ValueError, "Invalid fancy APDU header %r" % template[:match.start()]
+                self.head = self.tree.prepare() and [self.tree.static[0]] or list(self.tree)
+                self.have_le = length.lower() == "yy"
+                self.have_length = True
+                self.tree = current = _Fancy_APDU_Node()
+            elif placeholder is not None:
+                current.append(unicode(placeholder))
+            elif hexdigits is not None:
+                if len(current) > 0 and isinstance(current[-1], str):
+                    current[-1] = current[-1] + hexdigits
                 else:
-                    current.append(str(char))
-                
+                    current.append(hexdigits)
             elif char in allowed_parens.values():
                 if current.parent is None:
-                    raise ValueError
+                    raise ValueError, "Unbalanced %r in fancy APDU" % char
                 if allowed_parens[current.type] != char:
-                    raise ValueError
-                
+                    raise ValueError, "Unbalanced %r in fancy APDU" % char
                 current = current.parent
-                
             elif char in allowed_parens.keys():
-                current.append( Node(current, char) )
+                current.append( _Fancy_APDU_Node(current, char) )
                 current = current[-1]
-                
             else:
-                raise ValueError
+                raise ValueError, "Invalid character %r in fancy APDU" % char
         
-        if current != tree:
-            raise ValueError
+        if current is not self.tree:
+            raise ValueError, "Unbalanced parentheses in fancy APDU"
         
-        tree.make_binary()
-        tree.calculate_lengths()
+        self.tree.prepare()
+    
+    def instantiate(self, **values):
+        """Return a new C_APDU object from this template. The keyword arguments
+        give the binary string for each placeholder."""
+        tail, marks = self.tree.render(values)
         
-        apdu_head = apdu_head.strip()
-        if apdu_head != "":
-            l = tree.length
-            if have_le:
-	        if ext == True:
+        head = ""
+        if self.have_length:
+            head = "".join( [isinstance(e, unicode) and values[str(e)] or e for e in self.head] )
+            l = len(tail)
+            if self.have_le:
+                if self.ext == True:
                     l = l - 2
                 else:
                     l = l - 1
-	    if ext == True:
-	        formatted_len = "%06x" % l
-	    else:
-                formatted_len = "%02x" % l
-            apdu_head = binascii.a2b_hex("".join( (apdu_head + formatted_len).split() ))
-        
-        apdu_tail, marks = tree.flatten(offset=0)
+            if self.ext == True:
+                head = head + chr(l >> 16) + chr((l >> 8) & 0xff) + chr(l & 0xff)
+            else:
+                head = head + chr(l)
         
-        apdu = C_APDU(apdu_head + apdu_tail, marks = marks)
-        return apdu
+        return C_APDU(head + tail, marks = list(marks))
 
+FANCY_APDU_CACHE_SIZE = 256
+_fancy_apdu_cache = collections.OrderedDict()
+def compile_fancy_apdu(ext, template):
+    """Return a Fancy_APDU_Template for the template string. The most recently 
+    used FANCY_APDU_CACHE_SIZE templates are kept, so that scripts and secure
+    messaging, which use the same few templates over and over again, don't 
+    parse them again for every APDU."""
+    key = (ext, template)
+    try:
+        result = _fancy_apdu_cache.pop(key)
+    except KeyError:
+        result = Fancy_APDU_Template(ext, template)
+        if len(_fancy_apdu_cache) >= FANCY_APDU_CACHE_SIZE:
+            _fancy_apdu_cache.popitem(last = False)
+    _fancy_apdu_cache[key] = result
+    return result
 
 class R_APDU(APDU):
     "Class for a response APDU"
+    __slots__ = ("_SW1", "_SW2", "Lc")
     
     def _getsw(self):        return chr(self.SW1) + chr(self.SW2)
     def _setsw(self, value):
@@ -513,6 +725,12 @@ class R_APDU(APDU):
         if len(apdu) == 0: # To be filled in later
             return
         
+        if isinstance(apdu, str) and len(apdu) >= 2:
+            self._SW1, self._SW2 = ord(apdu[-2]), ord(apdu[-1])
+            self._data = apdu[:-2]
+            self.Lc = len(apdu) - 2
+            return
+        
         self.SW = apdu[-2:]
         self.data = apdu[:-2]
     
@@ -526,6 +744,7 @@ class R_APDU(APDU):
 
 class Raw_APDU(APDU):
     """Raw APDU that doesn't do any parsing"""
+    __slots__ = ("Lc", )
     
     def parse(self, apdu):
         "'Parse' the apdu and copy the values to this object"
@@ -538,53 +757,83 @@ class Raw_APDU(APDU):
     def _format_fields(self):
         return ""
 
+class _PN532_Frame_Type(type):
+    """Metaclass of PN532_Frame. Collects the MATCH_BY_* rules of each class 
+    when it is defined and registers it, so that _autosubclass() doesn't need 
+    to search for candidates. Subclasses defined in other modules (e.g. card 
+    drivers) are registered in the same way."""
+    MATCH_FIELDS = ("dir", "cmd")
+    
+    def __init__(cls, name, bases, namespace):
+        super(_PN532_Frame_Type, cls).__init__(name, bases, namespace)
+        
+        rules = []
+        for var in dir(cls):
+            if var.startswith("MATCH_BY_"):
+                fieldname = var[len("MATCH_BY_"):]
+                if fieldname not in cls.MATCH_FIELDS:
+                    raise TypeError, "%s: Can only match PN532 frames by %s, not %s" % (name,
+                        " or ".join(cls.MATCH_FIELDS), fieldname)
+                rules.append( (fieldname, getattr(cls, var)) )
+        cls._match_rules = tuple(rules)
+        
+        if not hasattr(cls, "_registry"):
+            cls._registry = []
+            cls._registry_cache = {}
+        else:
+            cls._registry.append(cls)
+            cls._registry_cache.clear()
+    
+    def find_subclass(cls, dir, cmd):
+        """Return the most specific registered subclass of cls (or cls itself)
+        whose rules match the given dir and cmd values"""
+        key = (cls, dir, cmd)
+        try:
+            return cls._registry_cache[key]
+        except KeyError:
+            pass
+        
+        values = {"dir": dir, "cmd": cmd}
+        result, max_score = cls, -1
+        for candidate in cls._registry:
+            if candidate is cls or not issubclass(candidate, cls):
+                continue
+            for fieldname, value in candidate._match_rules:
+                if values[fieldname] != value:
+                    break
+            else:
+                # On a tie the first registered candidate wins
+                if len(candidate._match_rules) > max_score:
+                    result, max_score = candidate, len(candidate._match_rules)
+        
+        cls._registry_cache[key] = result
+        return result
+
 class PN532_Frame(APDU):
     """This is not really an ISO 7816 APDU, but close enough to use the same
     class infrastructure."""
+    __metaclass__ = _PN532_Frame_Type
+    __slots__ = ("_DIR", "_CMD", "Lc")
     
     def __init__(self, *args, **kwargs):
         """If applicable: redirect instance creation to a subclass"""
         super(PN532_Frame, self).__init__(*args, **kwargs)
         self._autosubclass()
     
+    def with_params(self, **kwargs):
+        result = super(PN532_Frame, self).with_params(**kwargs)
+        result._autosubclass()
+        return result
+    
     def _autosubclass(self):
         """If a more appropriate subclass is known about, change __class__ to 
-        point to that class."""
-        
-        # Find all global classes that are a (possibly indirect) subclass of the current class
-        candidates = [ e for e in globals().values() 
-                      if inspect.isclass(e) and issubclass(e, self.__class__)
-                      and not e == self.__class__ ]
-        
-        # For each candidate: Find if it specifies any matching rules
-        # through class variables called MATCH_BY_* where * may be any field
-        # and if so, remove those classes that don't match. Also count the number
-        # of matches, to determine the best match
-        matches = {}
-        for candidate in candidates:
-            m = 0
-            for var in dir(candidate):
-                if var.startswith("MATCH_BY_"):
-                    fieldname = var[len("MATCH_BY_"):]
-                    if getattr(self, fieldname) == getattr(candidate, var):
-                        m = m + 1
-                    else:
-                        m = -1
-                        break
-            if m != -1:
-                matches[candidate] = m
-        
-        if len(matches) > 0:
-            # Remove all candidates that don't have maximal score
-            max_score = max(matches.values())
-            candidates = [ k for k,v in matches.items() if v == max_score ]
-            
-            # If there is still more than one candidate remaining, randomly choose
-            # the first one.
-            if len(candidates) > 0:
-                c = candidates[0]
-                if c != self.__class__:
-                    self.__class__ = c
+        point to that class. Candidates are all registered (possibly indirect) 
+        subclasses of the current class, whose MATCH_BY_* class variables (where
+        * is dir or cmd) all match this frame. The candidate with the most
+        matching rules wins."""
+        c = self.__class__.find_subclass(self.dir, self.cmd)
+        if c is not self.__class__:
+            self.__class__ = c
     
     DIR = _make_byte_property("DIR"); dir = DIR
     CMD = _make_byte_property("CMD"); cmd = CMD
@@ -670,7 +919,43 @@ class PN532_Response_InListPassiveTarget(PN532_Response):
         
         return True
 
+class PN532_Response_InAutoPoll(PN532_Response):
+    MATCH_BY_cmd = _DEFAULT_CMD = 0x61
     
+    ## Map InAutoPoll target types to the baudrate/modulation byte of InListPassiveTarget, 
+    ## whose target data format is used in the InAutoPoll response
+    TYPE_TO_BAUDRATE = {
+        0x00: 0, # Generic passive 106 kbps (ISO/IEC14443-4A, Mifare and DEP)
+        0x10: 0, # Mifare card
+        0x20: 0, # Passive 106 kbps ISO/IEC14443-4A
+        0x03: 3, # Passive 106 kbps ISO/IEC14443-3B
+        0x23: 3, # Passive 106 kbps ISO/IEC14443-4B
+    }
+    
+    def parse_result(self):
+        response = self.data
+        self.targets = {}
+        if len(response) == 0:
+            return False
+        
+        pos = 1
+        for i in range(ord(response[0])):
+            if pos + 2 > len(response):
+                return False
+            
+            type, length = ord(response[pos]), ord(response[pos+1])
+            target_data = response[pos+2:pos+2+length]
+            pos = pos + 2 + length
+            
+            if not self.TYPE_TO_BAUDRATE.has_key(type):
+                continue
+            
+            r = PN532_Response_InListPassiveTarget(data = "\x01" + target_data)
+            if not r.parse_result(self.TYPE_TO_BAUDRATE[type]):
+                return False
+            self.targets.update(r.targets)
+        
+        return True
 
 if __name__ == "__main__":
     response = """
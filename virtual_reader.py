@@ -0,0 +1,358 @@
+"""A reader with a card emulator behind it, for exercising the card drivers
+and measuring the host side of the read pipelines without any hardware.
+
+Example:
+    card = Virtual_Card()
+    card.add_df("\\x3f\\x00", "\\x01\\x00", aid="\\xa0\\x00\\x00\\x02\\x47\\x10\\x01")
+    card.add_ef("\\x3f\\x00\\x01\\x00", "\\x01\\x1e", data="...")
+    reader = Virtual_Reader(card, latency_model=Latency_Model(per_apdu=0.005, per_byte=0.0001))
+    reader.connect()
+    c = cards.new_card_object(reader)"""
+
+import time, binascii, fnmatch, utils, readers
+
+class Virtual_Node(object):
+    def __init__(self, fid, parent = None, sfi = None):
+        self.fid = fid
+        self.parent = parent
+        self.sfi = sfi
+        if parent is not None:
+            parent.children.append(self)
+    
+    def get_fcp(self):
+        "Return a minimal FCP template for this file"
+        return "\x62" + chr(len(self._fcp_contents())) + self._fcp_contents()
+
+class Virtual_DF(Virtual_Node):
+    def __init__(self, fid, parent = None, aid = None):
+        self.children = []
+        self.aid = aid
+        Virtual_Node.__init__(self, fid, parent)
+    
+    def find_child(self, fid, cls = Virtual_Node):
+        for child in self.children:
+            if child.fid == fid and isinstance(child, cls):
+                return child
+        return None
+    
+    def find_aid(self, aid):
+        "Search this DF and all DFs below it for an application with the given AID"
+        if self.aid is not None and self.aid[:len(aid)] == aid and len(aid) > 0:
+            return self
+        for child in self.children:
+            if isinstance(child, Virtual_DF):
+                result = child.find_aid(aid)
+                if result is not None:
+                    return result
+        return None
+    
+    def _fcp_contents(self):
+        result = "\x82\x01\x38" + "\x83\x02" + self.fid
+        if self.aid is not None:
+            result = result + "\x84" + chr(len(self.aid)) + self.aid
+        return result
+
+class Virtual_EF(Virtual_Node):
+    def __init__(self, fid, parent = None, data = "", sfi = None):
+        """data is either a string (for a transparent EF) or a list of strings
+        (for a linear record EF)"""
+        Virtual_Node.__init__(self, fid, parent, sfi)
+        self.data = data
+    
+    def is_transparent(self):
+        return isinstance(self.data, str)
+    
+    def _fcp_contents(self):
+        if self.is_transparent():
+            size = len(self.data)
+            descriptor = "\x01"
+        else:
+            size = sum( [len(e) for e in self.data] )
+            descriptor = "\x02"
+        return "\x80\x02" + chr(size >> 8 & 0xff) + chr(size & 0xff) + "\x82\x01" + descriptor + "\x83\x02" + self.fid
+
+class Virtual_Card(object):
+    """Emulates an ISO 7816-4 card with a file system of DFs and transparent or
+    record EFs. Understands SELECT (by FID, path and AID), READ BINARY, UPDATE BINARY
+    and READ RECORD. Additional or different behaviour can be scripted with script()."""
+    
+    DEFAULT_ATR = "\x3b\x00"
+    FID_MF = "\x3f\x00"
+    
+    def __init__(self, atr = None):
+        if atr is None:
+            atr = self.DEFAULT_ATR
+        self.atr = atr
+        self.mf = Virtual_DF(self.FID_MF)
+        self.scripts = []
+        self.reset()
+    
+    def reset(self):
+        "Reset the volatile state, as after a power cycle"
+        self.current_df = self.mf
+        self.current_ef = None
+    
+    def _lookup_path(self, path):
+        "Return the node identified by an absolute path (a string of FIDs, starting with the MF)"
+        if path[:2] != self.FID_MF:
+            raise ValueError, "Path must start with the MF"
+        node = self.mf
+        path = path[2:]
+        while len(path) > 0:
+            if not isinstance(node, Virtual_DF):
+                raise ValueError, "Path continues below an EF"
+            child = node.find_child(path[:2])
+            if child is None:
+                raise KeyError, "No such file %s" % binascii.b2a_hex(path[:2])
+            node = child
+            path = path[2:]
+        return node
+    
+    def add_df(self, parent_path, fid, aid = None):
+        "Create a DF below the DF with the absolute path parent_path"
+        return Virtual_DF(fid, self._lookup_path(parent_path), aid = aid)
+    
+    def add_ef(self, parent_path, fid, data = "", sfi = None):
+        "Create an EF below the DF with the absolute path parent_path"
+        return Virtual_EF(fid, self._lookup_path(parent_path), data = data, sfi = sfi)
+    
+    def script(self, pattern, response, count = None):
+        """Override the response to all command APDUs whose uppercase hexadecimal
+        representation matches pattern (an fnmatch pattern, e.g. "0084000008" or "00A4*").
+        response is either a binary string (data + SW) or a callable that gets the
+        C_APDU and returns such a string. If count is given, the script will be
+        removed after that many matches. Later scripts take precedence."""
+        self.scripts.insert(0, [pattern.upper(), response, count])
+    
+    def process(self, data):
+        "Process one command APDU (binary string), return the response APDU (binary string)"
+        apdu_hex = binascii.b2a_hex(data).upper()
+        for script in self.scripts:
+            if fnmatch.fnmatch(apdu_hex, script[0]):
+                if script[2] is not None:
+                    script[2] = script[2] - 1
+                    if script[2] <= 0:
+                        self.scripts.remove(script)
+                if callable(script[1]):
+                    return script[1](utils.C_APDU(data))
+                return script[1]
+        
+        try:
+            apdu = utils.C_APDU(data)
+        except ValueError:
+            return "\x67\x00"
+        
+        if apdu.cla & 0x80:
+            return "\x6e\x00"
+        
+        handler = getattr(self, "ins_%02X" % apdu.ins, None)
+        if handler is None:
+            return "\x6d\x00"
+        return handler(apdu)
+    
+    def _le(self, apdu):
+        "Return the number of bytes requested by the Le field, or None if there is none"
+        if not hasattr(apdu, "_Le"):
+            return None
+        if apdu.Le == 0:
+            return apdu.ext and 65536 or 256
+        return apdu.Le
+    
+    def ins_A4(self, apdu):
+        "SELECT"
+        node = None
+        if apdu.p1 == 0x00:
+            if len(apdu.data) == 0 or apdu.data == self.FID_MF:
+                node = self.mf
+            else:
+                node = self.current_df.find_child(apdu.data)
+        elif apdu.p1 == 0x01:
+            node = self.current_df.find_child(apdu.data, Virtual_DF)
+        elif apdu.p1 == 0x02:
+            node = self.current_df.find_child(apdu.data, Virtual_EF)
+        elif apdu.p1 == 0x03:
+            node = self.current_df.parent
+        elif apdu.p1 == 0x04:
+            node = self.mf.find_aid(apdu.data)
+        elif apdu.p1 == 0x08:
+            try:
+                node = self._lookup_path(self.FID_MF + apdu.data)
+            except (KeyError, ValueError):
+                node = None
+        else:
+            return "\x6a\x86"
+        
+        if node is None:
+            return "\x6a\x82"
+        
+        if isinstance(node, Virtual_DF):
+            self.current_df = node
+            self.current_ef = None
+        else:
+            self.current_df = node.parent
+            self.current_ef = node
+        
+        if apdu.p2 & 0x0c == 0x0c or self._le(apdu) is None:
+            return "\x90\x00"
+        return node.get_fcp() + "\x90\x00"
+    
+    def _select_ef_for_access(self, apdu):
+        "Handle the short EF identifier in P1 of READ/UPDATE BINARY. Returns (EF, offset) or (None, SW)"
+        if apdu.p1 & 0x80:
+            sfi = apdu.p1 & 0x1f
+            ef = None
+            for child in self.current_df.children:
+                if isinstance(child, Virtual_EF) and child.sfi == sfi:
+                    ef = child
+                    break
+            if ef is None:
+                return None, "\x6a\x82"
+            self.current_ef = ef
+            return ef, apdu.p2
+        
+        if self.current_ef is None:
+            return None, "\x69\x86"
+        return self.current_ef, (apdu.p1 << 8) | apdu.p2
+    
+    def ins_B0(self, apdu):
+        "READ BINARY"
+        ef, offset = self._select_ef_for_access(apdu)
+        if ef is None:
+            return offset
+        if not ef.is_transparent():
+            return "\x69\x81"
+        if offset >= len(ef.data):
+            return "\x6b\x00"
+        
+        le = self._le(apdu) or 256
+        result = ef.data[offset:offset+le]
+        if len(result) < le and apdu.Le != 0:
+            return result + "\x62\x82"
+        return result + "\x90\x00"
+    
+    def ins_D6(self, apdu):
+        "UPDATE BINARY"
+        ef, offset = self._select_ef_for_access(apdu)
+        if ef is None:
+            return offset
+        if not ef.is_transparent():
+            return "\x69\x81"
+        if offset > len(ef.data):
+            return "\x6b\x00"
+        ef.data = ef.data[:offset] + apdu.data + ef.data[offset+len(apdu.data):]
+        return "\x90\x00"
+    
+    def ins_B2(self, apdu):
+        "READ RECORD (by absolute record number)"
+        ef = self.current_ef
+        if apdu.p2 >> 3 != 0:
+            ef, sw = self._select_ef_for_access(utils.C_APDU(apdu, p1 = 0x80 | (apdu.p2 >> 3)))
+            if ef is None:
+                return sw
+        if ef is None:
+            return "\x69\x86"
+        if ef.is_transparent():
+            return "\x69\x81"
+        if apdu.p2 & 0x07 != 0x04 or not 1 <= apdu.p1 <= len(ef.data):
+            return "\x6a\x83"
+        return ef.data[apdu.p1-1] + "\x90\x00"
+
+class Latency_Model(object):
+    """Simple latency model: A fixed time per APDU plus a time per byte transferred
+    (in both directions). Both can be overriden per INS through per_ins, which maps INS
+    bytes to (per_apdu, per_byte) tuples. Subclass and override get_delay() for
+    anything more involved."""
+    
+    def __init__(self, per_apdu = 0.0, per_byte = 0.0, per_ins = None):
+        self.per_apdu = per_apdu
+        self.per_byte = per_byte
+        self.per_ins = per_ins or {}
+    
+    def get_delay(self, command, response):
+        "Return the number of seconds the exchange of the binary strings command and response takes"
+        per_apdu, per_byte = self.per_ins.get( len(command) > 1 and ord(command[1]) or None,
+            (self.per_apdu, self.per_byte) )
+        return per_apdu + per_byte * (len(command) + len(response))
+
+class Virtual_Reader(readers.Smartcard_Reader):
+    """A reader with a Virtual_Card in it. The latency model determines how long each
+    transceive() takes: when real_time is true the reader actually sleeps, otherwise
+    the time is only added up in virtual_time (for fast benchmarks)."""
+    
+    CONNECTION_ERRORS = (IOError, )
+    
+    def __init__(self, card = None, latency_model = None, name = "Virtual Reader", real_time = True):
+        self._name = name
+        self.card = card
+        self.latency_model = latency_model
+        self.real_time = real_time
+        self.virtual_time = 0.0
+        self.apdu_count = 0
+        self._connected = False
+    
+    name = property(lambda self: self._name, None, None, "The human readable name of the reader")
+    
+    def list_readers(cls):
+        "Virtual readers are never enumerated, instantiate them explicitly"
+        return []
+    list_readers = classmethod(list_readers)
+    
+    def insert_card(self, card):
+        self.card = card
+        self._connected = False
+    
+    def remove_card(self):
+        self.card = None
+        self._connected = False
+    
+    def drop_connection(self):
+        "Simulate a lost link: transceive() fails until the next connect, the card keeps its contents"
+        self._connected = False
+    
+    def _internal_connect(self):
+        if self.card is None:
+            yield self._CONNECT_NO_CARD
+        else:
+            self.card.reset()
+            self._connected = True
+            yield self._CONNECT_DONE
+    
+    def get_ATR(self):
+        if self.card is None:
+            return ""
+        return self.card.atr
+    
+    def transceive(self, data):
+        if not self._connected:
+            raise IOError, "No card connected"
+        
+        start = time.time()
+        response = self.card.process(data)
+        self.apdu_count = self.apdu_count + 1
+        
+        if self.latency_model is not None:
+            delay = self.latency_model.get_delay(data, response)
+            self.virtual_time = self.virtual_time + delay
+            if self.real_time and delay > 0:
+                time.sleep(delay)
+        else:
+            delay = time.time() - start
+        
+        self.get_statistics().record(data, response, delay)
+        return response
+    
+    def disconnect(self):
+        self._connected = False
+
+if __name__ == "__main__":
+    card = Virtual_Card()
+    card.add_df("\x3f\x00", "\x01\x00", aid = "\xa0\x00\x00\x02\x47\x10\x01")
+    card.add_ef("\x3f\x00\x01\x00", "\x01\x1e", data = "\x60\x16\x5f\x01\x04\x30\x31\x30\x37\x5f\x36\x06\x30\x34\x30\x30\x30\x30\x5c\x02\x61\x75")
+    card.add_ef("\x3f\x00\x01\x00", "\x01\x02", data = "\x75\x82\x75\x30" + "\x00" * 0x7530, sfi = 2)
+    
+    reader = Virtual_Reader(card, latency_model = Latency_Model(per_apdu = 0.01, per_byte = 0.0001), real_time = False)
+    reader.connect()
+    
+    for c_apdu in ("\x00\xa4\x04\x0c\x07\xa0\x00\x00\x02\x47\x10\x01", "\x00\xa4\x02\x0c\x02\x01\x1e", "\x00\xb0\x00\x00\x00", "\x00\xb0\x82\x00\x04"):
+        print utils.hexdump(c_apdu, short = True), "->", utils.hexdump(reader.transceive(c_apdu), short = True)
+    print "%i APDUs, %0.03gs virtual time" % (reader.apdu_count, reader.virtual_time)